@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+import csv
+import hashlib
+import os
+import pickle
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from sql import quote_identifier
+
+# TODO include synonyms?
+sqlite_types = ["text", "integer", "real", "blob"]
+
+special_table_types = ["table", "column", "datatype"]
+
+# Directory for pickled datatype and column models, in the build directory of this repository.
+# Override with the CURATRON_CACHE environment variable, or set it to the empty string to disable.
+CACHE_DIR = os.environ.get(
+    "CURATRON_CACHE",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "build", "cache"),
+)
+
+# Bump this whenever the classes below change shape, so that stale pickles are ignored.
+CACHE_VERSION = 2
+
+
+@dataclass
+class Datatype:
+    datatype: str
+    parent: Optional[str] = None
+    condition: Optional[str] = None
+    description: Optional[str] = None
+    # The 'SQL type' of this datatype or of its nearest ancestor that has one:
+    sql_type: Optional[str] = None
+    # The names of this datatype and its ancestors that have conditions, ordered from the root of
+    # the datatype tree down to this datatype:
+    checks: List[str] = field(default_factory=list)
+
+
+@dataclass
+class Column:
+    table: str
+    column: str
+    datatype: str
+    nulltype: Optional[str] = None
+    structure: Optional[str] = None
+    description: Optional[str] = None
+    sql_type: Optional[str] = None
+    configured: bool = False
+
+
+@dataclass
+class Table:
+    table: str
+    path: str
+    type: Optional[str] = None
+    description: Optional[str] = None
+    column: Dict[str, Column] = field(default_factory=dict)
+
+
+def blank(value):
+    """Given a cell value, return None if it is missing or only whitespace, otherwise the value."""
+    if value is None:
+        return None
+    if isinstance(value, str) and value.strip() == "":
+        return None
+    return value
+
+
+def require(row, required, nonempty, where):
+    """Given a row dict, lists of the columns it must have and of the columns that must not be
+    blank, and a description of where the row came from, raise an Exception if it is missing any."""
+    for column in required:
+        if column not in row:
+            raise Exception(f"Missing required column '{column}' reading '{where}'")
+    for column in nonempty:
+        if blank(row[column]) is None:
+            raise Exception(f"Missing required value for '{column}' reading '{where}'")
+
+
+def build_config(table_rows, datatype_rows, column_rows, source, model=None):
+    """Given lists of row dicts for the special 'table', 'datatype', and 'column' tables, and a
+    dict from table type to a description of where those rows came from (for error messages),
+    check the rows and return a config structure with resolved SQL types and datatype checks. If
+    a model built by build_model is given, the datatype and column rows are not used."""
+    config = {"table": {}, "datatype": {}, "special": {}}
+    for t in special_table_types:
+        config["special"][t] = None
+
+    # Load table table
+    where = source["table"]
+    for row in table_rows:
+        require(row, ["table", "path", "type"], ["table", "path"], where)
+        table = Table(
+            table=row["table"],
+            path=row["path"],
+            type=blank(row["type"]),
+            description=blank(row.get("description")),
+        )
+        if table.type in special_table_types:
+            if config["special"][table.type]:
+                raise Exception(f"Multiple tables with type '{table.type}' declared in '{where}'")
+            config["special"][table.type] = table.table
+        if table.type and table.type not in special_table_types:
+            raise Exception(f"Unrecognized table type '{table.type}' in '{where}'")
+        config["table"][table.table] = table
+
+    for table_type in special_table_types:
+        if config["special"][table_type] is None:
+            raise Exception(f"Missing required '{table_type}' table in '{where}'")
+
+    if model is None:
+        model = build_model(datatype_rows, column_rows, source)
+    config["datatype"], columns = model
+    for column in columns:
+        if column.table not in config["table"]:
+            raise Exception(f"Undefined table '{column.table}' reading '{source['column']}'")
+        config["table"][column.table].column[column.column] = column
+
+    return config
+
+
+def build_model(datatype_rows, column_rows, source):
+    """Given lists of row dicts for the special 'datatype' and 'column' tables, and a dict from
+    table type to a description of where those rows came from (for error messages), check the rows
+    and return a pair of a dict from datatype names to Datatypes, with resolved SQL types and
+    checks, and a list of Columns. Unlike the table rows, these do not depend on the reference."""
+    datatypes = {}
+
+    # Load datatype table
+    where = source["datatype"]
+    for row in datatype_rows:
+        require(row, ["datatype", "parent", "condition", "SQL type"], ["datatype"], where)
+        # TODO: validate conditions
+        datatype = Datatype(
+            datatype=row["datatype"],
+            parent=blank(row["parent"]),
+            condition=blank(row["condition"]),
+            description=blank(row.get("description")),
+            sql_type=blank(row["SQL type"]),
+        )
+        datatypes[datatype.datatype] = datatype
+    # TODO: Check for required datatypes: text, empty, line, word
+
+    # Flatten the datatype tree, so that validation does not have to climb it for every cell:
+    for datatype in datatypes.values():
+        chain = []
+        current = datatype
+        while current:
+            if current.datatype in chain:
+                raise Exception(f"Cyclic parent for datatype '{datatype.datatype}' in '{where}'")
+            chain.append(current.datatype)
+            if current.parent and current.parent not in datatypes:
+                raise Exception(f"Undefined parent '{current.parent}' reading '{where}'")
+            current = datatypes.get(current.parent)
+        for name in chain:
+            if datatypes[name].sql_type:
+                datatype.sql_type = datatypes[name].sql_type
+                break
+        datatype.checks = [n for n in reversed(chain) if datatypes[n].condition]
+
+    # Load column table
+    where = source["column"]
+    columns = []
+    for row in column_rows:
+        require(
+            row, ["table", "column", "nulltype", "datatype"], ["table", "column", "datatype"], where
+        )
+        column = Column(
+            table=row["table"],
+            column=row["column"],
+            datatype=row["datatype"],
+            nulltype=blank(row["nulltype"]),
+            structure=blank(row.get("structure")),
+            description=blank(row.get("description")),
+            configured=True,
+        )
+        if column.nulltype and column.nulltype not in datatypes:
+            raise Exception(f"Undefined nulltype '{column.nulltype}' reading '{where}'")
+        if column.datatype not in datatypes:
+            raise Exception(f"Undefined datatype '{column.datatype}' reading '{where}'")
+        column.sql_type = datatypes[column.datatype].sql_type
+        columns.append(column)
+
+    return datatypes, columns
+
+
+def read_tsv(path):
+    """Given a path, read a TSV file and return a list of row dicts."""
+    with open(path) as f:
+        rows = csv.DictReader(f, delimiter="\t")
+        rows = list(rows)
+        if len(rows) < 1:
+            raise Exception(f"No rows in {path}")
+        return rows
+
+
+def hash_file(path):
+    """Given a path, return the SHA-256 hex digest of the file's contents."""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def read_cached_model(digest):
+    """Given the digest of the datatype and column TSV files, return the cached model built from
+    them, or None if there is none."""
+    if not CACHE_DIR:
+        return None
+    cache_path = os.path.join(CACHE_DIR, f"model-{digest}.pickle")
+    try:
+        with open(cache_path, "rb") as f:
+            cached = pickle.load(f)
+        if cached["version"] != CACHE_VERSION:
+            return None
+        return cached["model"]
+    except (OSError, EOFError, KeyError, TypeError, pickle.UnpicklingError, AttributeError):
+        return None
+
+
+def write_cached_model(digest, model):
+    """Given the digest of the datatype and column TSV files and the model built from them, pickle
+    the model to the cache."""
+    if not CACHE_DIR:
+        return
+    cache_path = os.path.join(CACHE_DIR, f"model-{digest}.pickle")
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(
+                {"version": CACHE_VERSION, "model": model}, f, protocol=pickle.HIGHEST_PROTOCOL
+            )
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # The cache is only an optimization, so a read-only or missing build directory is fine.
+        pass
+
+
+def read_config_files(table_table_path):
+    """Given the path to a table TSV file, load and check the special 'table', 'column', and
+    'datatype' tables, and return a config structure. The datatype and column model is cached,
+    keyed by the contents of the datatype and column TSV files, which are the same for every
+    reference, so that runs over unchanged files skip parsing and checking them. The table rows
+    are applied on top, since their paths differ between references."""
+    path = table_table_path
+    table_rows = read_tsv(path)
+    for row in table_rows:
+        if row.get("type") == "table" and row.get("path") != path:
+            raise Exception(
+                f"Special 'table' path '{row['path']}' does not match this path '{path}'"
+            )
+    paths = {}
+    for row in table_rows:
+        table_type = blank(row.get("type"))
+        if table_type in ["datatype", "column"] and blank(row.get("path")):
+            paths[table_type] = row["path"]
+    source = {"table": path}
+    for table_type in ["datatype", "column"]:
+        if table_type not in paths:
+            raise Exception(f"Missing required '{table_type}' table in '{path}'")
+        source[table_type] = paths[table_type]
+
+    digest = hashlib.sha256()
+    for table_type in ["datatype", "column"]:
+        digest.update(hash_file(paths[table_type]).encode())
+    digest = digest.hexdigest()
+    model = read_cached_model(digest)
+    if not model:
+        datatype_rows = read_tsv(paths["datatype"])
+        column_rows = read_tsv(paths["column"])
+        model = build_model(datatype_rows, column_rows, source)
+        write_cached_model(digest, model)
+    return build_config(table_rows, None, None, source, model=model)
+
+
+def read_config_tables(conn):
+    """Given a connection to a database created by load.py, with a row factory that returns dicts,
+    load and check the special 'table', 'column', and 'datatype' tables, and return a config
+    structure."""
+    table_rows = list(conn.execute('SELECT * FROM "table"'))
+    special = {}
+    for row in table_rows:
+        table_type = blank(row.get("type"))
+        if table_type in special_table_types:
+            special[table_type] = row["table"]
+    for table_type in special_table_types:
+        if table_type not in special:
+            raise Exception(f"Missing required '{table_type}' table in 'table'")
+    datatype_rows = list(conn.execute(f"SELECT * FROM {quote_identifier(special['datatype'])}"))
+    column_rows = list(conn.execute(f"SELECT * FROM {quote_identifier(special['column'])}"))
+    source = {"table": "table", "datatype": special["datatype"], "column": special["column"]}
+    return build_config(table_rows, datatype_rows, column_rows, source)
@@ -5,15 +5,143 @@ import json
 import os
 
 from argparse import ArgumentParser
-from fetch import OUTPUTS
-from shutil import copy2
+
+# Number of characters read from a JSON file at a time:
+CHUNK_SIZE = 1 << 20
+
+WHITESPACE = " \t\n\r"
+
+# Characters that can follow a value in an array or object:
+DELIMITERS = WHITESPACE + ",]}:"
+
+
+class JSONScanner:
+    """Read the top-level array or object of a JSON file one item or member at a time, decoding each
+    with json.JSONDecoder.raw_decode from a buffer that is filled in chunks, so that only the
+    current chunk and the current value are held in memory."""
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def read(self, size):
+        """Given a number of characters, append them from the file to the unread part of the buffer.
+        Return False at the end of the file."""
+        chunk = self.f.read(size)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Skip whitespace and return the next character, or an empty string at the end of the
+        file."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read(self.chunk_size):
+                return ""
+
+    def expect(self, chars):
+        """Given a string of allowed characters, skip whitespace, then consume and return the next
+        character if it is one of them, otherwise raise a JSONDecodeError."""
+        char = self.peek()
+        if not char or char not in chars:
+            expected = " or ".join(repr(c) for c in chars)
+            raise json.JSONDecodeError(f"Expecting {expected}", self.buffer, self.pos)
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Skip whitespace, then decode and return the next JSON value."""
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # The value may continue past the end of the buffer:
+                if not self.read(size):
+                    raise
+            else:
+                # A number that reaches the end of the buffer, or a character that is not a
+                # delimiter, such as the '.' of '2.5', may also continue in the next chunk:
+                complete = end < len(self.buffer) and self.buffer[end] in DELIMITERS
+                if complete or not self.read(size):
+                    self.pos = end
+                    return value
+            # Read larger chunks as the value grows, so that it is decoded a few times at most:
+            size = max(size, len(self.buffer))
+
+    def items(self):
+        """Yield each item of the array at the current position."""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+    def members(self):
+        """Yield a pair of the key and the value of each member of the object at the current
+        position."""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key, self.value()
+            if self.expect(",}") == "}":
+                return
+
+
+def convert_table(path, fieldnames):
+    """Given the path to a table's JSON file and the table's column names, write those columns of
+    the rows in the file to the matching TSV file. The file holds either one row as an object or a
+    list of rows. Return 'dict' or 'list' for the type of the file, or None if it is neither, in
+    which case nothing is written."""
+    columns = set(fieldnames)
+    with open(path) as f:
+        scanner = JSONScanner(f)
+        first = scanner.peek()
+        if first == "{":
+            kind = "dict"
+            rows = [{key: value for key, value in scanner.members() if key in columns}]
+        elif first == "[":
+            kind = "list"
+            rows = scanner.items()
+        else:
+            return None
+        with open(path.replace(".json", ".tsv"), "w") as o:
+            writer = csv.DictWriter(o, fieldnames, delimiter="\t", lineterminator="\n", extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(rows)
+    return kind
+
 
 def main():
-    """Give a directory, read the `reference.json` file,
-    then copy the relevant parts of the src/reference/*.tsv files
-    into the given directory."""
+    """Given the path to a `table.tsv` file, convert the `<table>.json` file of each data table in
+    its directory to `<table>.tsv`, keeping only the columns listed for the table in the directory's
+    `column.tsv` file."""
     parser = ArgumentParser()
     parser.add_argument("table")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of worker processes for converting tables at the same time",
+        type=int,
+        default=1,
+    )
     args = parser.parse_args()
 
     dir = os.path.split(args.table)[0]
@@ -31,33 +159,25 @@ def main():
         rows = csv.DictReader(f, delimiter="\t")
         columns = list(rows)
 
+    paths = []
+    fieldnames = []
     for table in tables:
         if table == "prefix":
             continue
-        path = os.path.join(dir, f"{table}.json")
-        data = None
-        with open(path) as f:
-            data = json.load(f)
-        #print(path, len(data), print(type(data)))
-        fieldnames = []
-        for row in columns:
-            if row["table"] != table:
-                continue
-            fieldnames.append(row["column"])
-        if type(data) == dict:
-            print(path, "dict")
-            with open(path.replace(".json", ".tsv"), "w") as o:
-                writer = csv.DictWriter(o, fieldnames, delimiter="\t", lineterminator="\n", extrasaction="ignore")
-                writer.writeheader()
-                writer.writerow(data)
-        elif type(data) == list:
-            print(path, "list")
-            with open(path.replace(".json", ".tsv"), "w") as o:
-                writer = csv.DictWriter(o, fieldnames, delimiter="\t", lineterminator="\n", extrasaction="ignore")
-                writer.writeheader()
-                writer.writerows(data)
-        else:
-            continue
+        paths.append(os.path.join(dir, f"{table}.json"))
+        fieldnames.append([row["column"] for row in columns if row["table"] == table])
+
+    if args.jobs > 1:
+        # Only import the process pool (and multiprocessing) when it is needed:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            kinds = list(executor.map(convert_table, paths, fieldnames))
+    else:
+        kinds = map(convert_table, paths, fieldnames)
+    for path, kind in zip(paths, kinds):
+        if kind:
+            print(path, kind)
 
 
 if __name__ == "__main__":
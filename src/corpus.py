@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+import csv
+import logging
+import os
+import re
+import sqlite3
+import sys
+
+from argparse import ArgumentParser, ArgumentTypeError
+
+from sql import quote_identifier
+
+# Tables whose rows describe things shared by many references, keyed by their primary key. These
+# are stored once per corpus, with a separate table linking them to each reference.
+SHARED_TABLES = ["epitope"]
+
+# Tables that are not reference data (see save.is_data_table)
+SKIP_TABLES = ["prefix"]
+
+# Seconds to wait for a lock on a shard
+LOCK_TIMEOUT = 60
+
+# Max number of shards, since they are all attached to one connection to find duplicates, and
+# SQLite attaches at most 10 databases by default
+MAX_SHARDS = 10
+
+
+def shard_count(value):
+    """Given the value of the --shards option, return it as a number of shards, or raise an
+    ArgumentTypeError if it is not between 1 and MAX_SHARDS."""
+    try:
+        shards = int(value)
+    except ValueError:
+        raise ArgumentTypeError(f"invalid number of shards: '{value}'")
+    if shards < 1 or shards > MAX_SHARDS:
+        raise ArgumentTypeError(f"number of shards must be between 1 and {MAX_SHARDS}")
+    return shards
+
+
+def get_shard_path(corpus, shards, ref_id):
+    """Given the corpus path, the number of shards, and a reference ID, return the path of the
+    database holding that reference. A corpus with one shard is a single database file, otherwise
+    it is a directory of shard databases."""
+    if shards <= 1:
+        return corpus
+    return os.path.join(corpus, f"shard_{ref_id % shards}.db")
+
+
+def list_shards(corpus):
+    """Given the corpus path, return the list of its database files."""
+    if os.path.isdir(corpus):
+        return sorted(
+            os.path.join(corpus, name)
+            for name in os.listdir(corpus)
+            if re.fullmatch(r"shard_\d+\.db", name)
+        )
+    return [corpus]
+
+
+def get_reference_id(path):
+    """Given the path to a reference database, return the reference ID from its reference table or
+    else from its 'ref_<id>' directory name."""
+    conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+    try:
+        row = conn.execute("SELECT reference_id FROM reference LIMIT 1").fetchone()
+        if row and row[0] is not None:
+            return int(row[0])
+    except sqlite3.OperationalError:
+        pass
+    finally:
+        conn.close()
+    match = re.search(r"ref_(\d+)", os.path.abspath(path))
+    if not match:
+        raise ValueError(f"Cannot determine the reference ID of {path}")
+    return int(match.group(1))
+
+
+def get_columns(conn, schema, table):
+    """Given a connection, a schema name, and a table name, return a list of (name, type, primary)
+    tuples for the table's columns, or an empty list if it does not exist."""
+    rows = conn.execute(f"PRAGMA {quote_identifier(schema)}.table_info({quote_identifier(table)})")
+    return [(row[1], row[2], bool(row[5])) for row in rows]
+
+
+def get_data_tables(conn):
+    """Given a connection with a reference database attached as 'ref', return the names of its
+    loaded data tables."""
+    rows = conn.execute('SELECT "table", type FROM ref."table"').fetchall()
+    names = set(row[0] for row in conn.execute("SELECT name FROM ref.sqlite_master"))
+    return [
+        table
+        for table, table_type in rows
+        if not table_type and table not in SKIP_TABLES and table in names
+    ]
+
+
+def create_corpus_table(conn):
+    """Given a connection to a corpus database, create the table that records each corpus table's
+    key column and whether it is shared."""
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS _corpus_table (
+          "table" TEXT PRIMARY KEY,
+          "key" TEXT,
+          shared INTEGER NOT NULL
+        )"""
+    )
+
+
+def ensure_table(conn, table, columns, key, shared):
+    """Given a connection to a corpus database, a table name, the columns of that table in a
+    reference, its primary key column (or None), and whether the table is shared, create the corpus
+    table and its indexes if needed, and add any columns it is missing."""
+    existing = set(name for name, _, _ in get_columns(conn, "main", table))
+    name = quote_identifier(table)
+    conflict = quote_identifier(f"{table}_conflict")
+    if existing:
+        for column, sql_type, _ in columns:
+            if column not in existing:
+                column = quote_identifier(column)
+                conn.execute(f"ALTER TABLE {name} ADD COLUMN {column} {sql_type}")
+                if shared:
+                    conn.execute(f"ALTER TABLE {conflict} ADD COLUMN {column} {sql_type}")
+        return
+
+    conn.execute("INSERT OR REPLACE INTO _corpus_table VALUES (?, ?, ?)", (table, key, int(shared)))
+    lines = [f"  {quote_identifier(column)} {sql_type}" for column, sql_type, _ in columns]
+    if shared:
+        key_type = [sql_type for column, sql_type, _ in columns if column == key][0]
+        lines[[column for column, _, _ in columns].index(key)] += " PRIMARY KEY"
+        conn.execute(f"CREATE TABLE {name} (\n" + ",\n".join(lines) + "\n)")
+        reference = quote_identifier(f"{table}_reference")
+        conn.execute(
+            f"""CREATE TABLE {reference} (
+              {quote_identifier(key)} {key_type} NOT NULL,
+              _reference INTEGER NOT NULL,
+              PRIMARY KEY ({quote_identifier(key)}, _reference)
+            )"""
+        )
+        index = quote_identifier(f"idx_{table}_reference")
+        conn.execute(f"CREATE INDEX {index} ON {reference} (_reference)")
+        # Rows that differ from the shared row with the same key, by reference, and the reference's
+        # own conflict rows, which are flagged:
+        lines.insert(0, "  _conflict INTEGER NOT NULL DEFAULT 0")
+        lines.insert(0, "  _reference INTEGER NOT NULL")
+        lines = [line.replace(" PRIMARY KEY", "") for line in lines]
+        conn.execute(f"CREATE TABLE {conflict} (\n" + ",\n".join(lines) + "\n)")
+        index = quote_identifier(f"idx_{table}_conflict")
+        conn.execute(f"CREATE INDEX {index} ON {conflict} ({quote_identifier(key)})")
+        return
+
+    # Each reference is a partition of the table, and its conflict rows are flagged:
+    lines.insert(0, "  _conflict INTEGER NOT NULL DEFAULT 0")
+    lines.insert(0, "  _reference INTEGER NOT NULL")
+    conn.execute(f"CREATE TABLE {name} (\n" + ",\n".join(lines) + "\n)")
+    index = quote_identifier(f"idx_{table}_reference")
+    conn.execute(f"CREATE INDEX {index} ON {name} (_reference)")
+    if key:
+        # Keys are unique within a reference, and indexed across the corpus:
+        index = quote_identifier(f"idx_{table}_reference_{key}")
+        conn.execute(
+            f"""CREATE UNIQUE INDEX {index}
+            ON {name} (_reference, {quote_identifier(key)}) WHERE _conflict = 0"""
+        )
+        index = quote_identifier(f"idx_{table}_{key}")
+        conn.execute(f"CREATE INDEX {index} ON {name} ({quote_identifier(key)})")
+
+
+def index_foreign_keys(conn):
+    """Given a connection to a corpus database, index every column that has the same name as the key
+    of another corpus table, so that joins between tables across the corpus are indexed."""
+    rows = conn.execute('SELECT "table", "key" FROM _corpus_table').fetchall()
+    keys = dict((key, table) for table, key in rows if key)
+    for table, _ in rows:
+        for name, _, _ in get_columns(conn, "main", table):
+            if name in keys and keys[name] != table:
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(
+                        quote_identifier(f"idx_{table}_{name}"),
+                        quote_identifier(table),
+                        quote_identifier(name),
+                    )
+                )
+
+
+def load_reference(conn, path, ref_id):
+    """Given a connection to a corpus database, the path to a reference database, and its ID,
+    replace that reference's partition of the corpus with the reference's tables, in one
+    transaction."""
+    conn.execute("ATTACH DATABASE ? AS ref", (f"file:{os.path.abspath(path)}?mode=ro",))
+    try:
+        with conn:
+            create_corpus_table(conn)
+            for table in get_data_tables(conn):
+                columns = get_columns(conn, "ref", table)
+                keys = [name for name, _, primary in columns if primary]
+                key = keys[0] if keys else None
+                shared = table in SHARED_TABLES and key is not None
+                ensure_table(conn, table, columns, key, shared)
+                if shared:
+                    load_shared_rows(conn, table, key, columns, ref_id)
+                    continue
+                names = ", ".join(quote_identifier(name) for name, _, _ in columns)
+                name = quote_identifier(table)
+                conn.execute(f"DELETE FROM {name} WHERE _reference = ?", (ref_id,))
+                conn.execute(
+                    f"""INSERT INTO {name} (_reference, _conflict, {names})
+                    SELECT ?, 0, {names} FROM ref.{name}""",
+                    (ref_id,),
+                )
+                if get_columns(conn, "ref", f"{table}_conflict"):
+                    conn.execute(
+                        f"""INSERT INTO {name} (_reference, _conflict, {names})
+                        SELECT ?, 1, {names} FROM ref.{quote_identifier(table + "_conflict")}""",
+                        (ref_id,),
+                    )
+            index_foreign_keys(conn)
+    finally:
+        conn.execute("DETACH DATABASE ref")
+
+
+def load_shared_rows(conn, table, key, columns, ref_id):
+    """Given a connection to a corpus database with a reference attached as 'ref', a shared table,
+    its key column, the reference's columns for the table, and the reference ID, link the
+    reference's rows to the shared rows, adding the rows that are new to the corpus. Rows that
+    differ from the shared row with the same key are kept in the conflict table, along with the
+    reference's own conflict rows, which are flagged."""
+    names = ", ".join(quote_identifier(name) for name, _, _ in columns)
+    same = " AND ".join(
+        f"s.{quote_identifier(name)} IS r.{quote_identifier(name)}" for name, _, _ in columns
+    )
+    name = quote_identifier(table)
+    reference = quote_identifier(f"{table}_reference")
+    conflict = quote_identifier(f"{table}_conflict")
+    column = quote_identifier(key)
+    conn.execute(f"DELETE FROM {reference} WHERE _reference = ?", (ref_id,))
+    conn.execute(f"DELETE FROM {conflict} WHERE _reference = ?", (ref_id,))
+    conn.execute(f"DELETE FROM {name} WHERE {column} NOT IN (SELECT {column} FROM {reference})")
+    conn.execute(f"INSERT OR IGNORE INTO {name} ({names}) SELECT {names} FROM ref.{name}")
+    conn.execute(
+        f"""INSERT OR IGNORE INTO {reference} ({column}, _reference)
+        SELECT {column}, ? FROM ref.{name} WHERE {column} IS NOT NULL""",
+        (ref_id,),
+    )
+    conn.execute(
+        f"""INSERT INTO {conflict} (_reference, {names})
+        SELECT ?, {names} FROM ref.{name} AS r
+        WHERE NOT EXISTS (SELECT 1 FROM {name} AS s WHERE {same})""",
+        (ref_id,),
+    )
+    if not get_columns(conn, "ref", f"{table}_conflict"):
+        return
+    # The keys of conflict rows are invalid, so they are stored as NULL with their values in the
+    # _meta column. Recover them so that the rows can be found by key:
+    values = []
+    for name, sql_type, _ in columns:
+        if name == key and any(other == f"{key}_meta" for other, _, _ in columns):
+            meta = quote_identifier(f"{key}_meta")
+            value = f"json_extract(substr({meta}, 6, length({meta}) - 6), '$.value')"
+            values.append(f"COALESCE({column}, CAST({value} AS {sql_type or 'TEXT'}))")
+        else:
+            values.append(quote_identifier(name))
+    conn.execute(
+        f"""INSERT INTO {conflict} (_reference, _conflict, {names})
+        SELECT ?, 1, {", ".join(values)} FROM ref.{conflict}""",
+        (ref_id,),
+    )
+
+
+def attach_shards(conn, paths):
+    """Given a connection and the paths of a corpus's shard databases, attach them all and create
+    temporary views that combine each table across the shards."""
+    tables = {}
+    for i, path in enumerate(paths):
+        conn.execute(f"ATTACH DATABASE ? AS shard_{i}", (f"file:{os.path.abspath(path)}?mode=ro",))
+        rows = conn.execute(f"SELECT name FROM shard_{i}.sqlite_master WHERE type = 'table'")
+        for (name,) in rows:
+            tables.setdefault(name, []).append(i)
+    for table, shards in tables.items():
+        name = quote_identifier(table)
+        sql = " UNION ALL ".join(f"SELECT * FROM shard_{i}.{name}" for i in shards)
+        conn.execute(f"CREATE TEMP VIEW {name} AS {sql}")
+
+
+def find_duplicates(conn):
+    """Given a connection to a corpus database, or to temporary views over its shards, yield a tuple
+    of the table, key column, key value, and a comma-separated list of reference IDs for each key
+    value that is used by more than one reference, or that has different rows in different
+    references of a shared table. Each shard has its own copy of a shared table, so rows that
+    differ between references in different shards are different rows with the same key in the
+    combined view."""
+    rows = conn.execute('SELECT DISTINCT "table", "key", shared FROM _corpus_table')
+    for table, key, shared in sorted(rows.fetchall()):
+        if not key:
+            continue
+        name = quote_identifier(table)
+        column = quote_identifier(key)
+        if shared:
+            sql = f"""SELECT {column}, group_concat(DISTINCT _reference)
+                FROM {quote_identifier(table + "_reference")}
+                WHERE {column} IN (
+                  SELECT {column} FROM {quote_identifier(table + "_conflict")} WHERE _conflict = 0
+                  UNION
+                  SELECT {column} FROM (SELECT DISTINCT * FROM {name})
+                  GROUP BY {column} HAVING COUNT(*) > 1
+                )
+                GROUP BY {column} ORDER BY {column}"""
+        else:
+            sql = f"""SELECT {column}, group_concat(DISTINCT _reference) FROM {name}
+                WHERE _conflict = 0 AND {column} IS NOT NULL
+                GROUP BY {column} HAVING COUNT(DISTINCT _reference) > 1 ORDER BY {column}"""
+        for value, refs in conn.execute(sql):
+            yield table, key, value, refs
+
+
+def main():
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    load = subparsers.add_parser("load", help="Load reference databases into a corpus")
+    load.add_argument("corpus", help="Path to the corpus database, or directory of shards")
+    load.add_argument("db", help="One or more reference databases", nargs="+")
+    load.add_argument(
+        "-s",
+        "--shards",
+        help=f"Number of shard databases, at most {MAX_SHARDS}",
+        type=shard_count,
+        default=1,
+    )
+    duplicates = subparsers.add_parser(
+        "duplicates", help="Print the keys used by more than one reference as TSV"
+    )
+    duplicates.add_argument("corpus", help="Path to the corpus database, or directory of shards")
+    parser.add_argument("-v", "--verbose", help="Run with increased logging", action="store_true")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+    else:
+        logging.getLogger().setLevel(logging.WARN)
+
+    try:
+        if args.command == "load":
+            if args.shards > 1:
+                os.makedirs(args.corpus, exist_ok=True)
+            for path in args.db:
+                ref_id = get_reference_id(path)
+                shard = get_shard_path(args.corpus, args.shards, ref_id)
+                logging.info(f"Loading reference {ref_id} from {path} into {shard}")
+                with sqlite3.connect(
+                    f"file:{os.path.abspath(shard)}", uri=True, timeout=LOCK_TIMEOUT
+                ) as conn:
+                    load_reference(conn, path, ref_id)
+            return
+
+        paths = list_shards(args.corpus)
+        if not paths or not os.path.exists(paths[0]):
+            raise FileNotFoundError(f"No corpus at {args.corpus}")
+        if len(paths) == 1:
+            conn = sqlite3.connect(f"file:{os.path.abspath(paths[0])}?mode=ro", uri=True)
+        else:
+            conn = sqlite3.connect("file::memory:", uri=True)
+            attach_shards(conn, paths)
+        writer = csv.writer(sys.stdout, delimiter="\t", lineterminator="\n")
+        writer.writerow(["table", "column", "value", "references"])
+        for row in find_duplicates(conn):
+            writer.writerow(row)
+    except (FileNotFoundError, ValueError, sqlite3.OperationalError) as e:
+        sys.exit(e)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import csv
+import sqlite3
+import sys
+import time
+
+from argparse import ArgumentParser
+from functools import lru_cache
+
+# Number of CURIEs and IRIs remembered by each PrefixIndex:
+CACHE_SIZE = 1 << 16
+
+
+class PrefixIndex:
+    """An index of prefixes and their base IRIs for expanding CURIEs to IRIs and compacting IRIs to
+    CURIEs. Compaction uses the longest matching base, found by walking a character trie of the
+    bases, and both directions are memoized with an LRU cache."""
+
+    def __init__(self, prefixes):
+        """Given a dict from prefixes to base IRIs, build the index."""
+        self.prefixes = dict(prefixes)
+        self.trie = {}
+        for prefix, base in self.prefixes.items():
+            node = self.trie
+            for char in base:
+                node = node.setdefault(char, {})
+            # The empty key marks the end of a base. When two prefixes share a base, keep the first.
+            node.setdefault("", prefix)
+        self.expand = lru_cache(maxsize=CACHE_SIZE)(self._expand)
+        self.compact = lru_cache(maxsize=CACHE_SIZE)(self._compact)
+
+    def __reduce__(self):
+        # The caches cannot be pickled, so rebuild the index from its prefixes instead.
+        return (PrefixIndex, (self.prefixes,))
+
+    def __contains__(self, prefix):
+        return prefix in self.prefixes
+
+    def _expand(self, curie):
+        """Given a CURIE, return its IRI, or None if its prefix is not known."""
+        prefix, sep, local = curie.partition(":")
+        if not sep or prefix not in self.prefixes:
+            return None
+        return self.prefixes[prefix] + local
+
+    def _compact(self, iri):
+        """Given an IRI, return the CURIE using the longest matching base, or None if no base
+        matches."""
+        node = self.trie
+        match = None
+        for i, char in enumerate(iri):
+            node = node.get(char)
+            if node is None:
+                break
+            if "" in node:
+                match = (node[""], i + 1)
+        if not match:
+            return None
+        prefix, end = match
+        return f"{prefix}:{iri[end:]}"
+
+    def unknown_prefixes(self, curies):
+        """Given an iterable of CURIEs, return the set of their prefixes that are not known. Values
+        without a colon are ignored."""
+        unknown = set()
+        for prefix in set(curie.partition(":")[0] for curie in curies if ":" in curie):
+            if prefix not in self.prefixes:
+                unknown.add(prefix)
+        return unknown
+
+
+def read_prefix_index(path):
+    """Given the path to a prefix TSV file with 'prefix' and 'base' columns, return an index."""
+    prefixes = {}
+    with open(path) as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            if row["prefix"] and row["base"]:
+                prefixes[row["prefix"].strip()] = row["base"].strip()
+    return PrefixIndex(prefixes)
+
+
+def compact_statements(conn, index):
+    """Given a connection to an rdftab database and a PrefixIndex, add the index's prefixes to the
+    prefix table and replace the full IRIs (written as '<IRI>') in the stanza, subject, predicate,
+    and object columns of the statements table with CURIEs, where a prefix matches. Each column is
+    updated in a single pass over the table. Return the number of values compacted."""
+    conn.executemany(
+        "INSERT OR IGNORE INTO prefix (prefix, base) VALUES (?, ?)", index.prefixes.items()
+    )
+    conn.create_function("compact", 1, index.compact, deterministic=True)
+    count = 0
+    for column in ["stanza", "subject", "predicate", "object"]:
+        curie = f"compact(substr({column}, 2, length({column}) - 2))"
+        cursor = conn.execute(
+            f"""UPDATE statements SET {column} = {curie}
+            WHERE {column} LIKE '<%>' AND {curie} IS NOT NULL"""
+        )
+        count += cursor.rowcount
+    conn.commit()
+    return count
+
+
+def benchmark(conn, index, limit):
+    """Given a connection to an rdftab database, a PrefixIndex, and a maximum number of statements,
+    expand every subject and object CURIE to an IRI and compact it again, then print the rates."""
+    sql = "SELECT subject, object FROM statements"
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    values = []
+    for subject, obj in conn.execute(sql):
+        values.append(subject)
+        if obj:
+            values.append(obj)
+
+    start = time.perf_counter()
+    iris = []
+    for value in values:
+        if value.startswith("<") and value.endswith(">"):
+            iris.append(value[1:-1])
+        elif not value.startswith("_:"):
+            iri = index.expand(value)
+            if iri:
+                iris.append(iri)
+    expanded = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compacted = sum(1 for iri in iris if index.compact(iri))
+    elapsed = time.perf_counter() - start
+
+    print(f"values:    {len(values)}")
+    print(f"expand:    {len(values) / expanded:,.0f} per second")
+    print(f"compact:   {len(iris) / elapsed:,.0f} per second ({compacted} of {len(iris)} matched)")
+    print(f"expand cache:  {index.expand.cache_info()}")
+    print(f"compact cache: {index.compact.cache_info()}")
+
+
+def main():
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compact = subparsers.add_parser("compact", help="Compact the IRIs in an rdftab database")
+    compact.add_argument("prefixes", help="Path to the prefix TSV file")
+    compact.add_argument("db", help="Path to the rdftab database")
+    bench = subparsers.add_parser("bench", help="Benchmark expansion and compaction")
+    bench.add_argument("prefixes", help="Path to the prefix TSV file")
+    bench.add_argument("db", help="Path to the rdftab database")
+    bench.add_argument("-n", "--limit", help="Maximum number of statements to read", type=int)
+    args = parser.parse_args()
+
+    try:
+        index = read_prefix_index(args.prefixes)
+        with sqlite3.connect(args.db) as conn:
+            if args.command == "compact":
+                count = compact_statements(conn, index)
+                print(f"Compacted {count} values in {args.db}")
+            else:
+                benchmark(conn, index, args.limit)
+    except (FileNotFoundError, sqlite3.OperationalError) as e:
+        sys.exit(e)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,6 @@
 import json
 import logging
 import os
-import requests
 
 from argparse import ArgumentParser
 from collections import defaultdict
@@ -26,6 +25,9 @@ QUERY_URL = "https://query-api.iedb.org"
 
 
 def main():
+    # requests is slow to import, and the scripts that import OUTPUTS from here do not need it
+    import requests
+
     parser = ArgumentParser()
     parser.add_argument(
         "reference_id", help="One or more space-separated reference IDs to fetch", nargs="+"
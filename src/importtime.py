@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import subprocess
+import sys
+
+from argparse import ArgumentParser
+
+# Budgets in milliseconds for importing the module of each command line script, not counting the
+# modules the interpreter has already imported on startup:
+BUDGETS = {
+    "convert": 30,
+    "fetch": 30,
+    "generate": 30,
+    "load": 60,
+    "save": 50,
+    "terms": 50,
+    "corpus": 50,
+    "curie": 30,
+}
+
+# Lines of `python -X importtime` output: "import time: <self> | <cumulative> | <indented name>"
+IMPORTTIME_PATTERN = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)")
+
+
+def measure(module, runs):
+    """Given a module name and a number of runs, import the module in a fresh interpreter each run
+    and return the lowest cumulative import time in milliseconds, and the names of the slowest
+    three modules it imported directly in that run."""
+    src = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=src,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        # Each import is reported after the imports it triggered, which are indented further:
+        children = []
+        for line in result.stderr.splitlines():
+            match = IMPORTTIME_PATTERN.match(line)
+            if not match:
+                continue
+            cumulative, depth, name = int(match.group(2)), len(match.group(3)), match.group(4)
+            if depth == 3:
+                children.append((cumulative, name))
+            elif depth == 1 and name != module:
+                children = []
+            elif depth == 1:
+                total = cumulative / 1000
+                if best is None or total < best[0]:
+                    best = (total, [name for us, name in sorted(children, reverse=True)[:3]])
+    return best
+
+
+def main():
+    """Measure the import time of each command line script and exit with an error if any of them
+    is over its budget."""
+    parser = ArgumentParser()
+    parser.add_argument("module", help="Modules to measure (default: all)", nargs="*")
+    parser.add_argument("-n", "--runs", help="Number of runs per module", type=int, default=5)
+    args = parser.parse_args()
+
+    over = []
+    for module in args.module or BUDGETS.keys():
+        budget = BUDGETS.get(module)
+        total, slowest = measure(module, args.runs)
+        status = "ok"
+        if budget is not None and total > budget:
+            status = "OVER"
+            over.append(module)
+        print(f"{module:10} {total:7.1f} ms  (budget {budget} ms)  {status}  {', '.join(slowest)}")
+    if over:
+        sys.exit(f"Over the import time budget: {', '.join(over)}")
+
+
+if __name__ == "__main__":
+    main()
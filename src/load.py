@@ -1,116 +1,38 @@
 #!/usr/bin/env python3
 
 import csv
+import importlib.util
 import itertools
 import json
+import math
+import os
 import re
+import shutil
 import sqlite3
 import sys
+import tempfile
 
 from argparse import ArgumentParser
 from graphlib import CycleError, TopologicalSorter
-from sqlalchemy.sql.expression import text as sql_text
 
+from config import Column, read_config_files, sqlite_types
+from curie import read_prefix_index
+from sql import quote_identifier, quote_literal
 from validate import validate_rows
 
+# pyarrow is optional, and slow to import, so it is only imported to read large files:
+HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+
+# Files smaller than this many bytes are read with the csv module, even when pyarrow is installed:
+PYARROW_MIN_SIZE = 1 << 20
+
 CHUNK_SIZE = 2
 
-# TODO include synonyms?
-sqlite_types = ["text", "integer", "real", "blob"]
-
-special_table_types = ["table", "column", "datatype"]
-
-
-def read_config_files(table_table_path):
-    """Given the path to a table TSV file, load and check the special 'table', 'column', and
-    'datatype' tables, and return a config structure."""
-
-    def read_tsv(path):
-        """Given a path, read a TSV file and return a list of row dicts."""
-        with open(path) as f:
-            rows = csv.DictReader(f, delimiter="\t")
-            rows = list(rows)
-            if len(rows) < 1:
-                raise Exception(f"No rows in {path}")
-            return rows
-
-    path = table_table_path
-    rows = read_tsv(path)
-    config = {"table": {}, "datatype": {}, "special": {}}
-    for t in special_table_types:
-        config["special"][t] = None
-
-    # Load table table
-    for row in rows:
-        for column in ["table", "path", "type"]:
-            if column not in row or row[column] is None:
-                raise Exception(f"Missing required column '{column}' reading '{path}'")
-        for column in ["table", "path"]:
-            if row[column].strip() == "":
-                raise Exception(f"Missing required value for '{column}' reading '{path}'")
-        for column in ["type"]:
-            if row[column].strip() == "":
-                row[column] = None
-        if row["type"] == "table":
-            if row["path"] != path:
-                raise Exception(
-                    f"Special 'table' path '{row['path']}' does not match this path '{path}'"
-                )
-        if row["type"] in special_table_types:
-            if config["special"][row["type"]]:
-                raise Exception(f"Multiple tables with type '{row['type']}' declared in '{path}'")
-            config["special"][row["type"]] = row["table"]
-        if row["type"] and row["type"] not in special_table_types:
-            raise Exception(f"Unrecognized table type '{row['type']}' in '{path}'")
-        row["column"] = {}
-        config["table"][row["table"]] = row
-
-    for table_type in special_table_types:
-        if config["special"][table_type] is None:
-            raise Exception(f"Missing required '{table_type}' table in '{path}'")
-
-    # Load datatype table
-    table_name = config["special"]["datatype"]
-    path = config["table"][table_name]["path"]
-    rows = read_tsv(path)
-    for row in rows:
-        for column in ["datatype", "parent", "condition", "SQL type"]:
-            if column not in row or row[column] is None:
-                raise Exception(f"Missing required column '{column}' reading '{path}'")
-        for column in ["datatype"]:
-            if row[column].strip() == "":
-                raise Exception(f"Missing required value for '{column}' reading '{path}'")
-        for column in ["parent", "condition", "SQL type"]:
-            if row[column].strip() == "":
-                row[column] = None
-        # TODO: validate conditions
-        config["datatype"][row["datatype"]] = row
-    # TODO: Check for required datatypes: text, empty, line, word
-
-    # Load column table
-    table_name = config["special"]["column"]
-    path = config["table"][table_name]["path"]
-    rows = read_tsv(path)
-    for row in rows:
-        for column in ["table", "column", "nulltype", "datatype"]:
-            if column not in row or row[column] is None:
-                raise Exception(f"Missing required column '{column}' reading '{path}'")
-        for column in ["table", "column", "datatype"]:
-            if row[column].strip() == "":
-                raise Exception(f"Missing required value for '{column}' reading '{path}'")
-        for column in ["nulltype"]:
-            if row[column].strip() == "":
-                row[column] = None
-        if row["table"] not in config["table"]:
-            raise Exception(f"Undefined table '{row['table']}' reading '{path}'")
-        if row["nulltype"] and row["nulltype"] not in config["datatype"]:
-            raise Exception(f"Undefined nulltype '{row['nulltype']}' reading '{path}'")
-        if row["datatype"] not in config["datatype"]:
-            raise Exception(f"Undefined datatype '{row['datatype']}' reading '{path}'")
-        row["configured"] = True
-        config["table"][row["table"]]["column"][row["column"]] = row
-
-    return config
+# Seconds to wait for a lock on the main database while other workers are reading it:
+LOCK_TIMEOUT = 60
+
+# Functions converting valid cell strings to the Python types SQLite stores natively, by SQL type:
+sql_type_converters = {"integer": int, "real": float}
 
 
 def sort_tables(table_list, foreign_keys):
@@ -145,60 +67,126 @@ def sort_tables(table_list, foreign_keys):
         raise (CycleError(message))
 
 
+def read_tsv_header(path):
+    """Given the path to a TSV file, return the list of column names from its first line. Raise
+    StopIteration if there are no rows after the header."""
+    with open(path, newline="") as f:
+        reader = csv.reader(f, delimiter="\t")
+        try:
+            header = next(reader)
+            while not next(reader):
+                pass
+        except StopIteration:
+            raise StopIteration(f"No rows in {path}")
+    return header
+
+
+def row_width_error(path, line, width, actual):
+    """Given the path to a TSV file, a line number, and the expected and actual numbers of fields on
+    that line, return a ValueError describing the mismatch."""
+    return ValueError(f"Line {line} of {path} has {actual} fields, expected {width}")
+
+
+def read_tsv_rows(path, header):
+    """Given the path to a TSV file and its list of column names, skip the header and yield each row
+    as a tuple of strings with one item per column. Use pyarrow's streaming CSV reader if it is
+    installed and the file is large, otherwise fall back to the csv module. Either way, raise a
+    ValueError for a row with more or fewer fields than there are columns."""
+    width = len(header)
+    if HAS_PYARROW and os.path.getsize(path) >= PYARROW_MIN_SIZE:
+        import pyarrow
+        import pyarrow.csv
+
+        # pyarrow ignores exceptions raised by the handler, so the row is kept for the error below:
+        invalid_rows = []
+
+        def invalid_row_handler(row):
+            invalid_rows.append(row)
+            return "error"
+
+        try:
+            reader = pyarrow.csv.open_csv(
+                path,
+                read_options=pyarrow.csv.ReadOptions(column_names=header, skip_rows=1),
+                parse_options=pyarrow.csv.ParseOptions(
+                    delimiter="\t", newlines_in_values=True, invalid_row_handler=invalid_row_handler
+                ),
+                convert_options=pyarrow.csv.ConvertOptions(
+                    column_types={column: pyarrow.string() for column in header},
+                    strings_can_be_null=False,
+                    quoted_strings_can_be_null=False,
+                ),
+            )
+            for batch in reader:
+                yield from zip(*(batch.column(i).to_pylist() for i in range(width)))
+        except pyarrow.ArrowInvalid:
+            if not invalid_rows:
+                raise
+            row = invalid_rows[0]
+            raise row_width_error(path, row.number, width, row.actual_columns) from None
+        return
+
+    with open(path, newline="") as f:
+        reader = csv.reader(f, delimiter="\t")
+        next(reader, None)
+        for row in reader:
+            if not row:
+                continue
+            if len(row) != width:
+                raise row_width_error(path, reader.line_num, width, len(row))
+            yield tuple(row)
+
+
+def read_tsv_chunks(path, header, size):
+    """Given the path to a TSV file, its list of column names, and a chunk size, yield lists of at
+    most that many row tuples."""
+    rows = read_tsv_rows(path, header)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def create_db_and_write_sql(config):
     """Given a config map, read TSVs and write out SQL strings."""
+    # Until the tables are reloaded, any save state from an earlier load no longer applies:
+    config["db"].execute("DROP TABLE IF EXISTS save_state")
     table_list = list(config["table"].keys())
     for table_name in table_list:
-        path = config["table"][table_name]["path"]
-        with open(path) as f:
-            # Open a DictReader to get the first row from which we will read the column names of the
-            # table. Note that although we discard the rest this should not be inefficient. Since
-            # DictReader is implemented as an Iterator it does not read the whole file.
-            rows = csv.DictReader(f, delimiter="\t")
-
-            # Update columns
-            defined_columns = config["table"][table_name]["column"]
-            try:
-                actual_columns = list(next(rows).keys())
-            except StopIteration:
-                raise StopIteration(f"No rows in {path}")
-
-            all_columns = {}
-            for column_name in actual_columns:
-                column = {
-                    "table": table_name,
-                    "column": column_name,
-                    "nulltype": "empty",
-                    "datatype": "text",
-                }
-                if column_name in defined_columns:
-                    column = defined_columns[column_name]
-                all_columns[column_name] = column
-            config["table"][table_name]["column"] = all_columns
-
-            # Create the table and its corresponding conflict table:
-            for table in [table_name, table_name + "_conflict"]:
-                table_sql, table_constraints = create_schema(config, table)
-                if not table.endswith("_conflict"):
-                    config["constraints"]["foreign"][table_name] = table_constraints["foreign"]
-                    config["constraints"]["unique"][table_name] = table_constraints["unique"]
-                    config["constraints"]["primary"][table_name] = table_constraints["primary"]
-                config["db"].executescript(table_sql)
-                print("{}\n".format(table_sql))
-
-            # Create a view as the union of the regular and conflict versions of the table:
-            sql = safe_sql("DROP VIEW IF EXISTS :view;\n", {"view": table_name + "_view"})
-            sql += safe_sql(
-                "CREATE VIEW :view AS SELECT * FROM :table UNION SELECT * FROM :conflict;",
-                {
-                    "view": table_name + "_view",
-                    "table": table_name,
-                    "conflict": table_name + "_conflict",
-                },
+        path = config["table"][table_name].path
+        # Update columns
+        defined_columns = config["table"][table_name].column
+        actual_columns = read_tsv_header(path)
+
+        all_columns = {}
+        for column_name in actual_columns:
+            column = Column(
+                table=table_name,
+                column=column_name,
+                nulltype="empty",
+                datatype="text",
+                sql_type=get_SQL_type(config, "text"),
             )
-            config["db"].executescript(sql)
-            print("{}\n".format(sql))
-            config["db"].commit()
+            if column_name in defined_columns:
+                column = defined_columns[column_name]
+            all_columns[column_name] = column
+        config["table"][table_name].column = all_columns
+
+        # Create the table and its corresponding conflict table:
+        for table in [table_name, table_name + "_conflict"]:
+            table_sql, table_constraints = create_schema(config, table)
+            if not table.endswith("_conflict"):
+                config["constraints"]["foreign"][table_name] = table_constraints["foreign"]
+                config["constraints"]["unique"][table_name] = table_constraints["unique"]
+                config["constraints"]["primary"][table_name] = table_constraints["primary"]
+            config["db"].executescript(table_sql)
+            print("{}\n".format(table_sql))
+
+        sql = create_view(config, table_name)
+        config["db"].executescript(sql)
+        print("{}\n".format(sql))
+        config["db"].commit()
 
     # Sort tables according to their foreign key dependencies so that tables are always loaded
     # after the tables they depend on:
@@ -206,32 +194,183 @@ def create_db_and_write_sql(config):
     print("TABLE LIST", table_list)
 
     # Now load the rows:
+    if config.get("jobs", 1) > 1:
+        load_tables_in_parallel(config, table_list)
+    else:
+        for table_name in table_list:
+            load_table(config, table_name, sys.stdout)
+
+    # Count the changes made to each table from now on, so save.py can skip unchanged tables:
+    sql = create_save_state(config)
+    config["db"].executescript(sql)
+    print("{}\n".format(sql))
+    config["db"].commit()
+
+
+def load_table(config, table_name, log):
+    """Given a config map, a table name, and a file to log SQL strings to, read the table's TSV,
+    validate its rows, and insert them into the database in chunks."""
+    path = config["table"][table_name].path
+    header = list(config["table"][table_name].column.keys())
+    for i, chunk in enumerate(read_tsv_chunks(path, header, CHUNK_SIZE)):
+        chunk = [dict(zip(header, row)) for row in chunk]
+        sql = insert_rows(config, table_name, chunk)
+        config["db"].executescript(sql)
+        config["db"].commit()
+        print("{}\n\n".format(sql), file=log)
+        print("-- end of chunk {}\n\n".format(i), file=log)
+
+
+def stage_table(config, table_name, staging_path, log_path):
+    """Given a config map (without a database connection), a table name, and paths for a staging
+    database and a SQL log, validate and load the table into the staging database, with the main
+    database attached read-only so that foreign keys can be checked against the tables that have
+    already been merged. This runs in a worker process."""
+    conn = sqlite3.connect(f"file:{staging_path}", uri=True, timeout=LOCK_TIMEOUT)
+    try:
+        config = dict(config, db=conn)
+        for table in [table_name, table_name + "_conflict"]:
+            table_sql, _ = create_schema(config, table)
+            conn.executescript(table_sql)
+        # Unqualified table names resolve to the staging database before the attached one, so
+        # uniqueness is checked against the staged rows and foreign keys against the main database:
+        source = "file:{}?mode=ro".format(os.path.abspath(config["db_path"]))
+        conn.execute("ATTACH DATABASE ? AS source", (source,))
+        with open(log_path, "w") as log:
+            load_table(config, table_name, log)
+    finally:
+        conn.close()
+
+
+def merge_table(config, table_name, staging_path):
+    """Given a config map, a table name, and the path to the staging database for that table, copy
+    the staged rows into the main database in a single transaction."""
+    conn = config["db"]
+    conn.commit()
+    conn.execute("ATTACH DATABASE ? AS staging", (staging_path,))
+    try:
+        with conn:
+            for table in [table_name, table_name + "_conflict"]:
+                table = quote_identifier(table)
+                conn.execute(
+                    f"INSERT INTO main.{table} SELECT * FROM staging.{table} ORDER BY rowid"
+                )
+    finally:
+        conn.execute("DETACH DATABASE staging")
+
+
+def load_tables_in_parallel(config, table_list):
+    """Given a config map and a list of table names, validate tables whose dependencies have all
+    been loaded at the same time in worker processes, each into its own staging database, then merge
+    each staged table into the main database as it finishes. Print the SQL log of each table when
+    it is merged."""
+    # Only import the process pool (and multiprocessing) when it is needed:
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+    ts = TopologicalSorter()
     for table_name in table_list:
-        path = config["table"][table_name]["path"]
-        with open(path) as f:
-            rows = csv.DictReader(f, delimiter="\t")
-            # Collect data into fixed-length chunks or blocks
-            # See: https://docs.python.org/3.9/library/itertools.html#itertools-recipes
-            chunks = itertools.zip_longest(*([iter(rows)] * CHUNK_SIZE))
-            for i, chunk in enumerate(chunks):
-                chunk = filter(None, chunk)
-                sql = insert_rows(config, table_name, chunk)
-                config["db"].executescript(sql)
-                config["db"].commit()
-                print("{}\n\n".format(sql))
-                print("-- end of chunk {}\n\n".format(i))
+        deps = set(fkey["ftable"] for fkey in config["constraints"]["foreign"].get(table_name, []))
+        ts.add(table_name, *deps)
+    ts.prepare()
+
+    worker_config = {key: value for key, value in config.items() if key != "db"}
+    staging_dir = tempfile.mkdtemp(prefix="staging-", dir=os.path.dirname(config["db_path"]))
+    try:
+        with ProcessPoolExecutor(max_workers=config["jobs"]) as executor:
+            pending = {}
+            while ts.is_active():
+                for table_name in ts.get_ready():
+                    staging_path = os.path.join(staging_dir, f"{table_name}.db")
+                    log_path = os.path.join(staging_dir, f"{table_name}.sql")
+                    future = executor.submit(
+                        stage_table, worker_config, table_name, staging_path, log_path
+                    )
+                    pending[future] = (table_name, staging_path, log_path)
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    table_name, staging_path, log_path = pending.pop(future)
+                    future.result()
+                    merge_table(config, table_name, staging_path)
+                    with open(log_path) as log:
+                        shutil.copyfileobj(log, sys.stdout)
+                    ts.done(table_name)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
 
 def get_SQL_type(config, datatype):
-    """Given the config structure and the name of a datatype, climb the datatype tree (as required),
-    and return the first 'SQL type' found."""
+    """Given the config structure and the name of a datatype, return the first 'SQL type' found
+    climbing the datatype tree, as resolved when the config was read."""
     if "datatype" not in config:
         raise Exception("Missing datatypes in config")
     if datatype not in config["datatype"]:
         return None
-    if config["datatype"][datatype]["SQL type"]:
-        return config["datatype"][datatype]["SQL type"]
-    return get_SQL_type(config, config["datatype"][datatype]["parent"])
+    return config["datatype"][datatype].sql_type
+
+
+def create_save_state(config):
+    """Given the config structure, return a SQL string that creates the 'save_state' table, with a
+    row for each table's TSV file, and triggers that count the changes to each table. save.py
+    records the count and a checksum of each file it writes, and rewrites the file only when the
+    count or the file has changed since."""
+    output = [
+        "DROP TABLE IF EXISTS save_state;",
+        "CREATE TABLE save_state (",
+        "  path TEXT PRIMARY KEY,",
+        '  "table" TEXT,',
+        "  changes INTEGER NOT NULL DEFAULT 0,",
+        "  saved INTEGER,",
+        "  checksum TEXT",
+        ");",
+    ]
+    for table_name, table in config["table"].items():
+        output.append(
+            'INSERT INTO save_state (path, "table") VALUES ({}, {});'.format(
+                quote_literal(table.path), quote_literal(table_name)
+            )
+        )
+        for event in ["INSERT", "UPDATE", "DELETE"]:
+            output.append(
+                "CREATE TRIGGER {} AFTER {} ON {} BEGIN "
+                'UPDATE save_state SET changes = changes + 1 WHERE "table" = {}; END;'.format(
+                    quote_identifier(f"{table_name}_{event.lower()}_changes"),
+                    event,
+                    quote_identifier(table_name),
+                    quote_literal(table_name),
+                )
+            )
+    return "\n".join(output)
+
+
+def create_view(config, table_name):
+    """Given the config structure and a table name, return a SQL string that creates a view of the
+    rows of the table and its conflict table, with a 'row_key' column holding each row's primary
+    key (or first column) value and a 'row_origin' column holding the name of the row's table.
+    Both tables get an index on the row key, so reads of the view in key order can merge the two
+    tables without sorting, and rows are not compared against each other as with UNION."""
+    columns = config["table"][table_name].column
+    primary = config["constraints"]["primary"].get(table_name)
+    key = primary[0] if primary else next(iter(columns))
+    # Invalid cells, which include the keys of conflict rows, are stored as NULL with their values
+    # in the _meta column, so recover those values for the row key:
+    column = quote_identifier(key)
+    meta = quote_identifier(key + "_meta")
+    row_key = "COALESCE({}, CAST(json_extract(substr({}, 6, length({}) - 6), '$.value') AS {}))"
+    row_key = row_key.format(column, meta, meta, columns[key].sql_type)
+
+    view = quote_identifier(table_name + "_view")
+    output = [f"DROP VIEW IF EXISTS {view};"]
+    selects = []
+    for table in [table_name, table_name + "_conflict"]:
+        index = quote_identifier(table + "_row_key")
+        output.append(f"CREATE INDEX {index} ON {quote_identifier(table)} ({row_key});")
+        selects.append(
+            "SELECT *, {} AS row_key, {} AS row_origin FROM {}".format(
+                row_key, quote_literal(table), quote_identifier(table)
+            )
+        )
+    output.append(f"CREATE VIEW {view} AS\n" + "\nUNION ALL\n".join(selects) + ";")
+    return "\n".join(output)
 
 
 def create_schema(config, table_name):
@@ -239,33 +378,32 @@ def create_schema(config, table_name):
     column C and its matching C_meta column, then return the schema string as well as a list of the
     table's constraints."""
     output = [
-        safe_sql("DROP TABLE IF EXISTS :table;", {"table": table_name}),
-        safe_sql("CREATE TABLE :table (", {"table": table_name}),
+        f"DROP TABLE IF EXISTS {quote_identifier(table_name)};",
+        f"CREATE TABLE {quote_identifier(table_name)} (",
     ]
-    columns = config["table"][table_name.replace("_conflict", "")]["column"]
+    columns = config["table"][table_name.replace("_conflict", "")].column
     table_constraints = {"foreign": [], "unique": [], "primary": []}
     c = len(columns.values())
     r = 0
     for row in columns.values():
         r += 1
-        sql_type = get_SQL_type(config, row["datatype"])
+        sql_type = row.sql_type
         if not sql_type:
-            raise Exception(f"Missing SQL type for {row['datatype']}")
+            raise Exception(f"Missing SQL type for {row.datatype}")
         if not sql_type.lower() in sqlite_types:
-            raise Exception(f"Unrecognized SQL type '{sql_type}' for {row['datatype']}")
-        line = f"  :col {sql_type}"
-        params = {"col": row["column"]}
-        structure = row.get("structure")
+            raise Exception(f"Unrecognized SQL type '{sql_type}' for {row.datatype}")
+        line = f"  {quote_identifier(row.column)} {sql_type}"
+        structure = row.structure
         if structure and not table_name.endswith("_conflict"):
             keys = re.split(r"\s+", structure)
             for key in keys:
                 key = key.strip().lower()
                 if key == "primary":
                     line += " PRIMARY KEY"
-                    table_constraints["primary"].append(row["column"])
+                    table_constraints["primary"].append(row.column)
                 elif key == "unique":
                     line += " UNIQUE"
-                    table_constraints["unique"].append(row["column"])
+                    table_constraints["unique"].append(row.column)
                 else:
                     match = re.fullmatch(r"^from\((.+)\)$", key)
                     if match:
@@ -275,25 +413,25 @@ def create_schema(config, table_name):
                                 "Invalid foreign key: {} for: {}".format(structure, table_name)
                             )
                         table_constraints["foreign"].append(
-                            {"column": row["column"], "ftable": foreign[0], "fcolumn": foreign[1]}
+                            {"column": row.column, "ftable": foreign[0], "fcolumn": foreign[1]}
                         )
         line += ","
-        output.append(safe_sql(line, params))
-        line = "  :meta TEXT"
+        output.append(line)
+        line = f"  {quote_identifier(row.column + '_meta')} TEXT"
         if r >= c and not table_constraints["foreign"]:
             line += ""
         else:
             line += ","
-        output.append(safe_sql(line, {"meta": row["column"] + "_meta"}))
+        output.append(line)
 
     num_keys = len(table_constraints["foreign"])
     for i, fkey in enumerate(table_constraints["foreign"]):
         output.append(
-            safe_sql(
-                "  FOREIGN KEY (:column) REFERENCES :ftable(:fcolumn){}".format(
-                    "," if i < (num_keys - 1) else ""
-                ),
-                {"column": fkey["column"], "ftable": fkey["ftable"], "fcolumn": fkey["fcolumn"]},
+            "  FOREIGN KEY ({}) REFERENCES {}({}){}".format(
+                quote_identifier(fkey["column"]),
+                quote_identifier(fkey["ftable"]),
+                quote_identifier(fkey["fcolumn"]),
+                "," if i < (num_keys - 1) else "",
             )
         )
     output.append(");")
@@ -304,6 +442,13 @@ def insert_rows(config, table_name, rows):
     """Given a config map, a table name, and a list of rows (dicts from column names to column
     values), return a SQL string for an INSERT statement with VALUES for all the rows."""
 
+    columns = config["table"][table_name].column
+    converters = {}
+    for column in columns.values():
+        converter = sql_type_converters.get((column.sql_type or "").lower())
+        if converter:
+            converters[column.column] = converter
+
     def generate_sql(table_name, rows):
         lines = []
         for row in rows:
@@ -311,26 +456,21 @@ def insert_rows(config, table_name, rows):
             # from the row record to prevent it from being interpreted as a cell:
             del row["duplicate"]
             values = []
-            params = {}
-            for column, cell in row.items():
-                column = column.replace(" ", "_")
+            for column_name, cell in row.items():
                 value = None
                 if "nulltype" in cell and cell["nulltype"]:
                     value = None
                 elif cell["valid"]:
-                    value = cell["value"]
+                    value = convert_value(converters.get(column_name), cell["value"])
                     cell.pop("value")
-                values.append(f":{column}")
-                values.append(f":{column}_meta")
-                params[column] = value
-                params[column + "_meta"] = f"json({json.dumps(cell)})"
+                values.append(quote_literal(value))
+                values.append(quote_literal(f"json({json.dumps(cell)})"))
             line = ", ".join(values)
-            line = f"({line})"
-            lines.append(safe_sql(line, params))
+            lines.append(f"({line})")
 
         output = ""
         if lines:
-            output += safe_sql("INSERT INTO :table VALUES", {"table": table_name})
+            output += f"INSERT INTO {quote_identifier(table_name)} VALUES"
             output += "\n"
             output += ",\n".join(lines)
             output += ";"
@@ -351,21 +491,41 @@ def insert_rows(config, table_name, rows):
     )
 
 
-def safe_sql(template, params):
-    """Given a SQL query template with variables and a dict of parameters,
-    return an escaped SQL string."""
-    stmt = sql_text(template).bindparams(**params)
-    return str(stmt.compile(compile_kwargs={"literal_binds": True}))
+def convert_value(converter, value):
+    """Given a converter function (or None) and a valid cell value string, return the converted
+    value, or the string itself if there is no converter or it does not apply. Floats such as
+    'inf', 'nan' or '1e999' that have no finite value are kept as strings."""
+    if converter is None:
+        return value
+    try:
+        converted = converter(value)
+    except ValueError:
+        return value
+    if isinstance(converted, float) and not math.isfinite(converted):
+        return value
+    return converted
+
 
 def main():
     parser = ArgumentParser()
     parser.add_argument("db")
     parser.add_argument("table")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of worker processes for validating independent tables at the same time",
+        type=int,
+        default=1,
+    )
     args = parser.parse_args()
     try:
         config = read_config_files(args.table)
-        with sqlite3.connect(args.db) as conn:
+        with sqlite3.connect(args.db, timeout=LOCK_TIMEOUT) as conn:
             config["db"] = conn
+            config["db_path"] = args.db
+            config["jobs"] = args.jobs
+            if "prefix" in config["table"]:
+                config["prefixes"] = read_prefix_index(config["table"]["prefix"].path)
             config["constraints"] = {"foreign": {}, "unique": {}, "primary": {}}
             create_db_and_write_sql(config)
     except (CycleError, FileNotFoundError, StopIteration, ValueError) as e:
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import math
+import time
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+
+def fetch(url, timeout):
+    """Given a URL and a timeout in seconds, read the whole response and return a pair of the
+    latency in seconds and whether the request succeeded."""
+    start = time.perf_counter()
+    try:
+        with urlopen(url, timeout=timeout) as response:
+            response.read()
+            ok = response.status < 400
+    except (HTTPError, URLError, OSError):
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+def percentile(values, p):
+    """Given a sorted list of values and a percentage, return the nearest-rank percentile."""
+    if not values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+
+def main():
+    """Send a number of GET requests, cycling through the given URLs, from concurrent clients, and
+    report throughput and latency."""
+    parser = ArgumentParser()
+    parser.add_argument("url", help="One or more URLs to request", nargs="+")
+    parser.add_argument("-n", "--requests", help="Total number of requests", type=int, default=1000)
+    parser.add_argument("-c", "--concurrency", help="Number of clients", type=int, default=10)
+    parser.add_argument("--timeout", help="Seconds to wait for a response", type=float, default=30)
+    args = parser.parse_args()
+
+    urls = [args.url[i % len(args.url)] for i in range(args.requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda url: fetch(url, args.timeout), urls))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, ok in results if ok)
+    errors = len(results) - len(latencies)
+    print(f"requests:     {len(results)}")
+    print(f"errors:       {errors}")
+    print(f"elapsed:      {elapsed:.2f} s")
+    print(f"requests/sec: {len(latencies) / elapsed:.1f}")
+    if latencies:
+        print(f"mean:         {sum(latencies) / len(latencies) * 1000:.1f} ms")
+        print(f"p50:          {percentile(latencies, 50) * 1000:.1f} ms")
+        print(f"p99:          {percentile(latencies, 99) * 1000:.1f} ms")
+        print(f"max:          {latencies[-1] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,20 @@
 #! /usr/bin/env python3
 
+import json
 import os
+import sqlite3
+import threading
 
-from flask import Flask, render_template, request
+from bisect import bisect_right
+from collections import OrderedDict
+
+from flask import Flask, Response, abort, render_template, request, stream_with_context
 from gizmos.search import search
 from gizmos.tree import tree as render_tree
+from sql import quote_identifier
 from sqlalchemy import create_engine
+from sqlalchemy.sql.expression import text as sql_text
+from terms import get_tree_path as get_term_tree_path
 from wsgiref.handlers import CGIHandler
 
 app = Flask(
@@ -24,6 +33,29 @@ TREES = [
     "geolocation",
 ]
 
+# Default and maximum number of primary key values returned per page of reference JSON:
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+MESSAGE_LEVELS = ["error", "warn", "info", "debug"]
+
+# Number of children loaded per request when expanding a tree node:
+CHILD_PAGE_SIZE = 100
+# Terms with more children than this are rendered without them, and their children are loaded by
+# the page instead:
+LAZY_CHILDREN = 500
+
+# Max number of terms whose sorted children are remembered, for paging through them:
+CHILD_CACHE_SIZE = 32
+# Map from an engine and a term ID to the term's children as sorted (label, ID) pairs, and a map
+# from each child ID to its position:
+CHILD_CACHE = OrderedDict()
+CHILD_CACHE_LOCK = threading.Lock()
+
+# Map from tree name to the (inode, mtime) signature of its database file and an engine for it:
+ENGINES = {}
+ENGINES_LOCK = threading.Lock()
+
 
 @app.route("/")
 def index():
@@ -55,7 +87,8 @@ def show_tree(tree):
         include_search=True,
         standalone=True,
     )
-    return render_template("tree.html", tree=html)
+    base = f"{request.script_root}/browse/{tree}/"
+    return render_template("tree.html", tree=html, base=base, page_size=CHILD_PAGE_SIZE)
 
 
 @app.route("/browse/<tree>/<term>")
@@ -69,20 +102,376 @@ def show_term(tree, term):
         # Return search results
         data = search(conn, request.args.get("text"))
         return data
+    base = f"{request.script_root}/browse/{tree}/"
+    if count_children(conn, term) > LAZY_CHILDREN:
+        # Rendering every child of a very broad term is slow, so only render the term itself and
+        # let the page load its children a page at a time:
+        return render_template(
+            "tree.html",
+            tree=None,
+            base=base,
+            term=term,
+            label=get_label(conn, term),
+            parents=get_parents(conn, term),
+            page_size=CHILD_PAGE_SIZE,
+        )
     html = render_tree(
         conn, tree, term, href="./{curie}", title="", include_search=True, standalone=True
     )
-    return render_template("tree.html", tree=html)
+    return render_template("tree.html", tree=html, base=base, page_size=CHILD_PAGE_SIZE)
+
+
+@app.route("/browse/<tree>/<term>/children")
+def show_children(tree, term):
+    """Return one page of the children of a term as JSON, ordered by label. Each child has its ID,
+    label, and number of children. 'after' is the ID of the last child of the previous page, 'limit'
+    is the size of the page, and 'count' is the total number of children of the term."""
+    conn = create_connection(tree)
+    try:
+        limit = int(request.args.get("limit", CHILD_PAGE_SIZE))
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, MAX_PAGE_SIZE)
+    return {
+        "term": term,
+        "count": len(get_sorted_children(conn, term)[0]),
+        "children": get_children(conn, term, request.args.get("after") or None, limit),
+    }
+
+
+@app.route("/ref/<int:ref_id>/messages")
+def show_reference_messages(ref_id):
+    """Stream one page of validation messages for a reference as JSON. Messages are ordered by table
+    and then by primary key. The 'table' and 'level' parameters filter the messages, and the 'next'
+    object in each page gives the 'from' and 'after' parameters for the following page. 'after' is
+    left out when the following page starts at the beginning of a table."""
+    conn = create_reference_connection(ref_id)
+    tables = get_reference_tables(conn)
+    table = request.args.get("table")
+    if table:
+        if table not in tables:
+            abort(404)
+        tables = [table]
+    start = request.args.get("from")
+    if start:
+        if start not in tables:
+            abort(400)
+        tables = tables[tables.index(start) :]
+    level = request.args.get("level")
+    if level and level not in MESSAGE_LEVELS:
+        abort(400)
+    limit = get_page_size()
+
+    if not tables:
+        abort(404)
+    # Check the 'after' parameter before the response starts:
+    after = request.args.get("after") or None
+    first = iter_reference_rows(conn, tables[0], after if start else None)
+
+    def generate():
+        # Close the connection even if the client disconnects in the middle of the response:
+        try:
+            yield '{"messages": ['
+            count = 0
+            next_page = None
+            for i, table in enumerate(tables):
+                fieldnames, pages = first if i == 0 else iter_reference_rows(conn, table, None)
+                scanned = None
+                for key, row in pages:
+                    # Only stop between primary key values, since conflict rows share them:
+                    if count >= limit and key != scanned:
+                        # At the start of a table, the next page starts from its first row:
+                        next_page = {"from": table}
+                        if scanned is not None:
+                            next_page["after"] = scanned
+                        break
+                    scanned = key
+                    for column in fieldnames:
+                        for message in row[column]["messages"]:
+                            if level and message.get("level") != level:
+                                continue
+                            message = dict(message, table=table, row=key, column=column)
+                            yield ("" if count == 0 else ",") + "\n" + json.dumps(message)
+                            count += 1
+                if next_page:
+                    break
+            yield "\n], " + '"next": {}}}\n'.format(json.dumps(next_page))
+        finally:
+            conn.close()
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+@app.route("/ref/<int:ref_id>/<table>")
+def show_reference_table(ref_id, table):
+    """Stream one page of rows from a reference table, and its conflict table, as JSON. Each cell
+    has its value, validity, and messages. Set 'valid' to 'false' to return only rows with invalid
+    cells, or 'true' for only valid rows. Pass the 'next' value from a page as the 'after' parameter
+    to get the following page."""
+    conn = create_reference_connection(ref_id)
+    if table not in get_reference_tables(conn):
+        abort(404)
+    valid = request.args.get("valid")
+    if valid not in [None, "true", "false"]:
+        abort(400)
+    limit = get_page_size()
+    fieldnames, pages = iter_reference_rows(conn, table, request.args.get("after") or None)
+
+    def generate():
+        # Close the connection even if the client disconnects in the middle of the response:
+        try:
+            yield '{"table": ' + json.dumps(table) + ', "rows": ['
+            count = 0
+            next_page = None
+            scanned = None
+            for key, row in pages:
+                # Only stop between primary key values, since conflict rows share them:
+                if count >= limit and key != scanned:
+                    next_page = scanned
+                    break
+                scanned = key
+                if valid:
+                    row_valid = all(row[column]["valid"] for column in fieldnames)
+                    if row_valid != (valid == "true"):
+                        continue
+                yield ("" if count == 0 else ",") + "\n" + json.dumps(row)
+                count += 1
+            yield "\n], " + '"next": {}}}\n'.format(json.dumps(next_page))
+        finally:
+            conn.close()
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+def get_page_size():
+    """Return the page size requested by the 'limit' parameter, or the default page size."""
+    limit = request.args.get("limit", PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def get_reference_tables(conn):
+    """Given a connection to a reference database, return the list of loaded tables."""
+    rows = conn.execute('SELECT "table" FROM table_view ORDER BY "table"')
+    names = set(
+        row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'view'")
+    )
+    return [row[0] for row in rows if f"{row[0]}_view" in names]
+
+
+def iter_reference_rows(conn, table, after):
+    """Given a connection to a reference database, a table name, and a primary key value (or None),
+    return the list of column names and an iterator over pairs of a primary key value and a row
+    dict for each row in the table's view with a greater primary key, ordered by primary key. Each
+    row maps a column name to a dict with the cell's value, validity, and messages."""
+    key = None
+    types = {}
+    for column in conn.execute(f"PRAGMA table_info({quote_identifier(table)})"):
+        if column[1].endswith("_meta"):
+            continue
+        types[column[1]] = column[2] or "TEXT"
+        if column[5] and not key:
+            key = column[1]
+    fieldnames = list(types.keys())
+    if not key:
+        key = fieldnames[0]
+    key_type = types[key]
+    if after is not None and key_type.lower() == "integer":
+        try:
+            after = int(after)
+        except ValueError:
+            abort(400)
+
+    # The view's row_key column holds the primary key of each row, including the rows in the
+    # conflict table, and both tables are indexed on it (see load.create_view):
+    sql = f"SELECT * FROM {quote_identifier(table + '_view')}"
+    params = []
+    if after is not None:
+        sql += " WHERE row_key > ?"
+        params.append(after)
+    sql += " ORDER BY row_key"
+
+    def iterate():
+        cursor = conn.execute(sql, params)
+        names = [column[0] for column in cursor.description]
+        for values in cursor:
+            record = dict(zip(names, values))
+            row = {}
+            for column in fieldnames:
+                meta = record.get(f"{column}_meta")
+                cell = json.loads(meta[5:-1]) if meta else {"valid": True, "messages": []}
+                if "value" not in cell:
+                    cell["value"] = record[column]
+                row[column] = cell
+            yield record["row_key"], row
+
+    return fieldnames, iterate()
+
+
+def create_reference_connection(ref_id):
+    """Given a reference ID, return a read-only connection to its reference database."""
+    path = os.path.abspath(f"build/ref_{ref_id}/reference.db")
+    if not os.path.exists(path):
+        abort(404)
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+
+
+def count_children(conn, term):
+    """Given an engine for a tree database and a term ID, return the number of its children."""
+    with conn.connect() as c:
+        result = c.execute(
+            sql_text(
+                """SELECT COUNT(DISTINCT subject) FROM statements
+                WHERE predicate = 'rdfs:subClassOf' AND object = :term
+                  AND substr(subject, 1, 2) != '_:'"""
+            ),
+            {"term": term},
+        )
+        return result.fetchone()[0]
+
+
+def get_sorted_children(conn, term):
+    """Given an engine for a tree database and a term ID, return a list of (label, ID) pairs for the
+    term's children, sorted by label and then ID, and a dict from each child ID to its position in
+    the list. The results for recently paged terms are cached for each engine, so each page after
+    the first costs the same however many children the term has."""
+    key = (conn, term)
+    with CHILD_CACHE_LOCK:
+        if key in CHILD_CACHE:
+            CHILD_CACHE.move_to_end(key)
+            return CHILD_CACHE[key]
+    with conn.connect() as c:
+        results = c.execute(
+            sql_text(
+                """SELECT label, id FROM (
+                  SELECT c.subject AS id,
+                    COALESCE((SELECT value FROM statements
+                              WHERE stanza = c.subject AND subject = c.subject
+                                AND predicate = 'rdfs:label'
+                              LIMIT 1), c.subject) AS label
+                  FROM (SELECT DISTINCT subject FROM statements
+                        WHERE predicate = 'rdfs:subClassOf' AND object = :term
+                          AND substr(subject, 1, 2) != '_:') AS c
+                )
+                ORDER BY label, id"""
+            ),
+            {"term": term},
+        )
+        children = [tuple(row) for row in results]
+    positions = {child: i for i, (_, child) in enumerate(children)}
+    with CHILD_CACHE_LOCK:
+        CHILD_CACHE[key] = (children, positions)
+        while len(CHILD_CACHE) > CHILD_CACHE_SIZE:
+            CHILD_CACHE.popitem(last=False)
+    return children, positions
+
+
+def get_children(conn, term, after, limit):
+    """Given an engine for a tree database, a term ID, the ID of the last child on the previous page
+    (or None), and a limit, return the next page of the term's children, ordered by label and then
+    ID, as a list of dicts with their IDs, labels, and numbers of children. The page is selected by
+    its (label, ID) keys before any children are counted, so only the children on the page are
+    counted."""
+    children, positions = get_sorted_children(conn, term)
+    start = 0
+    if after in positions:
+        start = positions[after] + 1
+    elif after:
+        start = bisect_right(children, (get_label(conn, after), after))
+    page = children[start : start + limit]
+    if not page:
+        return []
+
+    params = {f"id{i}": child for i, (_, child) in enumerate(page)}
+    with conn.connect() as c:
+        results = c.execute(
+            sql_text(
+                """SELECT object, COUNT(DISTINCT subject) FROM statements
+                WHERE predicate = 'rdfs:subClassOf' AND object IN ({})
+                  AND substr(subject, 1, 2) != '_:'
+                GROUP BY object""".format(", ".join(f":{name}" for name in params))
+            ),
+            params,
+        )
+        counts = dict(tuple(row) for row in results)
+    return [{"id": child, "label": label, "children": counts.get(child, 0)} for label, child in page]
+
+
+def get_label(conn, term):
+    """Given an engine for a tree database and a term ID, return its label or the ID itself."""
+    with conn.connect() as c:
+        result = c.execute(
+            sql_text(
+                """SELECT value FROM statements
+                WHERE stanza = :term AND subject = :term AND predicate = 'rdfs:label' LIMIT 1"""
+            ),
+            {"term": term},
+        )
+        row = result.fetchone()
+        return row[0] if row else term
+
+
+def get_parents(conn, term):
+    """Given an engine for a tree database and a term ID, return a list of dicts with the IDs and
+    labels of its named parents."""
+    with conn.connect() as c:
+        results = c.execute(
+            sql_text(
+                """SELECT DISTINCT object FROM statements
+                WHERE stanza = :term AND subject = :term AND predicate = 'rdfs:subClassOf'
+                  AND substr(object, 1, 2) != '_:'"""
+            ),
+            {"term": term},
+        )
+        parents = [row[0] for row in results]
+    return [{"id": parent, "label": get_label(conn, parent)} for parent in parents]
+
+
+def get_tree_path(tree):
+    """Given a tree name, return the absolute path to its database."""
+    return os.path.abspath(get_term_tree_path(tree))
 
 
 def create_connection(tree):
-    if tree == "geolocation":
-        path = "build/geolocation.db"
-    else:
-        path = f"build/{tree}-tree.db"
-    abspath = os.path.abspath(path)
-    db_url = "sqlite:///" + abspath
-    return create_engine(db_url)
+    """Given a tree name, return an engine for its database. Engines are cached per process and
+    replaced when the database file is rebuilt, so each tree is only opened once per rebuild."""
+    path = get_tree_path(tree)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        # The database is being rebuilt: keep serving the old one, if this process has it open
+        if tree in ENGINES:
+            return ENGINES[tree][1]
+        abort(404)
+    signature = (stat.st_ino, stat.st_mtime_ns)
+    with ENGINES_LOCK:
+        cached = ENGINES.get(tree)
+        if cached and cached[0] == signature:
+            return cached[1]
+        engine = create_engine("sqlite:///" + path)
+        ENGINES[tree] = (signature, engine)
+    if cached:
+        # Connections that are checked out keep working until they are returned
+        cached[1].dispose()
+    return engine
+
+
+def warm_connections():
+    """Open a pooled connection to every tree database that exists, so that the first request for
+    each tree does not pay for opening it."""
+    for tree in TREES:
+        if not os.path.exists(get_tree_path(tree)):
+            continue
+        engine = create_connection(tree)
+        with engine.connect() as conn:
+            conn.exec_driver_sql("SELECT 1 FROM statements LIMIT 1")
 
 
 def main():
@@ -7,163 +7,208 @@ import sqlite3
 import sys
 
 from argparse import ArgumentParser
-from sqlalchemy.sql.expression import text as sql_text
-from load import sqlite_types, special_table_types
-
-
-def read_config_tables(conn):
-    config = {"db": conn, "table": {}, "datatype": {}, "special": {}}
-    for t in special_table_types:
-        config["special"][t] = None
-
-    # Load table table
-    table_name = "table"
-    rows = config["db"].execute(f"SELECT * FROM `{table_name}`")
-    for row in rows:
-        for column in ["table", "path", "type"]:
-            if column not in row:
-                raise Exception(f"Missing required column '{column}' reading '{table_name}'")
-        for column in ["table", "path"]:
-            if row[column].strip() == "":
-                raise Exception(f"Missing required value for '{column}' reading '{table_name}'")
-        for column in ["type"]:
-            if not row[column]:
-                continue
-            if not type(row[column]) == str:
-                continue
-            if row[column].strip() == "":
-                row[column] = None
-        if row["type"] in special_table_types:
-            if config["special"][row["type"]]:
-                raise Exception(f"Multiple tables with type '{row['type']}' declared in '{table_name}'")
-            config["special"][row["type"]] = row["table"]
-        if row["type"] and row["type"] not in special_table_types:
-            raise Exception(f"Unrecognized table type '{row['type']}' in '{table_name}'")
-        row["column"] = {}
-        config["table"][row["table"]] = row
-
-    for table_type in special_table_types:
-        if config["special"][table_type] is None:
-            raise Exception(f"Missing required '{table_type}' table in '{path}'")
-
-    # Load datatype table
-    table_name = config["special"]["datatype"]
-    rows = config["db"].execute(f"SELECT * FROM `{table_name}`")
-    for row in rows:
-        for column in ["datatype", "parent", "condition", "SQL type"]:
-            if column not in row:
-                raise Exception(f"Missing required column '{column}' reading '{table_name}'")
-        for column in ["datatype"]:
-            if not row[column]:
-                continue
-            if not type(row[column]) == str:
-                continue
-            if row[column].strip() == "":
-                raise Exception(f"Missing required value for '{column}' reading '{table_name}'")
-        for column in ["parent", "condition", "SQL type"]:
-            if not row[column]:
-                continue
-            if not type(row[column]) == str:
-                continue
-            if row[column].strip() == "":
-                row[column] = None
-        # TODO: validate conditions
-        config["datatype"][row["datatype"]] = row
-    # TODO: Check for required datatypes: text, empty, line, word
-
-    # Load column table
-    table_name = config["special"]["column"]
-    rows = config["db"].execute(f"SELECT * FROM `{table_name}`")
-    for row in rows:
-        for column in ["table", "column", "nulltype", "datatype"]:
-            if column not in row:
-                raise Exception(f"Missing required column '{column}' reading '{table_name}'")
-        for column in ["table", "column", "datatype"]:
-            if not row[column]:
-                continue
-            if not type(row[column]) == str:
-                continue
-            if row[column].strip() == "":
-                raise Exception(f"Missing required value for '{column}' reading '{table_name}'")
-        for column in ["nulltype"]:
-            if not row[column]:
-                continue
-            if not type(row[column]) == str:
-                continue
-            if row[column].strip() == "":
-                row[column] = None
-        if row["table"] not in config["table"]:
-            raise Exception(f"Undefined table '{row['table']}' reading '{table_name}'")
-        if row["nulltype"] and row["nulltype"] not in config["datatype"]:
-            raise Exception(f"Undefined nulltype '{row['nulltype']}' reading '{table_name}'")
-        if row["datatype"] not in config["datatype"]:
-            raise Exception(f"Undefined datatype '{row['datatype']}' reading '{table_name}'")
-        row["configured"] = True
-        config["table"][row["table"]]["column"][row["column"]] = row
-
-    return config
+from collections import defaultdict
+
+from config import hash_file, read_config_tables
+from sql import quote_identifier
+
+
+# Background colours for cells with messages, by message level (see resources/template.html)
+LEVEL_FILLS = {"error": "FFABAB", "warn": "FFCDAB", "info": "FFF8AB", "debug": "ABC4FF"}
+LEVEL_ORDER = ["error", "warn", "info", "debug"]
+
+# openpyxl is slow to import, so it is only imported when a workbook is written (see save_tables)
+openpyxl = None
+
 
 def save_tables(config):
+    """Given a config map, write each table to its TSV file, then write all the messages to the
+    message file. When the database has a save state, tables that have not changed since they were
+    last saved, and whose files have not changed either, are skipped, and their messages are kept
+    from the current message file. Files are only replaced when their contents change."""
+    state = read_save_state(config["db"])
+    message_path = config["message_path"]
+    old_messages = None
+    if is_saved(state, message_path):
+        old_messages = read_messages(message_path)
+
+    global openpyxl
+    workbook = None
+    if config.get("xlsx_path"):
+        import openpyxl.cell
+        import openpyxl.comments
+        import openpyxl.styles
+
+        # A write-only workbook streams each row to disk as it is appended
+        workbook = openpyxl.Workbook(write_only=True)
     for table in config["table"].keys():
-        save_table(config, table)
+        sheet = None
+        if workbook and is_data_table(config, table):
+            sheet = workbook.create_sheet(table)
+        path = config["table"][table].path
+        if sheet is None and old_messages is not None and is_saved(state, path):
+            config["message"].extend(old_messages[table])
+            continue
+        checksum = save_table(config, table, sheet)
+        if state is not None:
+            config["db"].execute(
+                "UPDATE save_state SET saved = changes, checksum = ? WHERE path = ?",
+                (checksum, path),
+            )
+    if workbook:
+        workbook.save(config["xlsx_path"])
 
     # save message.tsv
-    path = config["message_path"]
-    with open(path, "w") as f:
+    temp_path = message_path + ".tmp"
+    with open(temp_path, "w") as f:
         fieldnames = ["table", "cell", "rule", "level", "message"]
         writer = csv.DictWriter(f, fieldnames, delimiter="\t", lineterminator="\n", extrasaction="ignore")
         writer.writeheader()
         writer.writerows(config["message"])
+    checksum = replace_if_changed(temp_path, message_path)
+    if state is not None:
+        config["db"].execute(
+            "INSERT OR REPLACE INTO save_state (path, saved, checksum) VALUES (?, 0, ?)",
+            (message_path, checksum),
+        )
+    config["db"].commit()
+
+
+def read_save_state(conn):
+    """Given a connection to a database created by load.py, return a dict from file paths to their
+    rows in the save_state table, or None if the database has no save state."""
+    sql = "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'save_state'"
+    if not list(conn.execute(sql)):
+        return None
+    return {row["path"]: row for row in conn.execute("SELECT * FROM save_state")}
+
+
+def is_saved(state, path):
+    """Given the save state (or None) and a file path, return True if the file was saved after the
+    last change to its table and its contents have not changed since."""
+    if not state or path not in state:
+        return False
+    row = state[path]
+    if row["saved"] is None or row["saved"] != row["changes"] or not row["checksum"]:
+        return False
+    return os.path.exists(path) and hash_file(path) == row["checksum"]
 
-def save_table(config, table):
-    path = config["table"][table]["path"]
+
+def read_messages(path):
+    """Given the path to a message TSV file, return a dict from table names to their messages."""
+    messages = defaultdict(list)
+    with open(path) as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            messages[row["table"]].append(row)
+    return messages
+
+
+def replace_if_changed(temp_path, path):
+    """Given the path to a newly written file and the path it should replace, move the new file into
+    place if the contents differ, otherwise remove it, so that unchanged files are not touched.
+    Return the checksum of the contents."""
+    checksum = hash_file(temp_path)
+    if os.path.exists(path) and hash_file(path) == checksum:
+        os.remove(temp_path)
+    else:
+        os.replace(temp_path, path)
+    return checksum
+
+
+def is_data_table(config, table):
+    """Given a config map and a table name, return True if the table holds reference data, rather
+    than configuration or prefixes."""
+    return config["table"][table].type is None and table != "prefix"
+
+
+def xlsx_cell(sheet, value, messages):
+    """Given a write-only worksheet, a cell value, and a list of validation messages, return a cell
+    for appending to the worksheet, with a comment listing the messages and a fill for the most
+    severe message level. openpyxl must already have been imported by save_tables."""
+    cell = openpyxl.cell.WriteOnlyCell(sheet, value=value)
+    if not messages:
+        return cell
+    levels = [m.get("level") for m in messages if m.get("level") in LEVEL_ORDER]
+    if levels:
+        level = min(levels, key=LEVEL_ORDER.index)
+        color = LEVEL_FILLS[level]
+        cell.fill = openpyxl.styles.PatternFill(
+            start_color=color, end_color=color, fill_type="solid"
+        )
+    text = "\n".join(f"{m.get('level')}: {m.get('message')}" for m in messages)
+    cell.comment = openpyxl.comments.Comment(text, "curatron")
+    return cell
+
+
+def get_column_letter(index):
+    """Given a 1-based column index, return its spreadsheet column letters, e.g. 28 is 'AB'."""
+    letters = ""
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def save_table(config, table, sheet=None):
+    """Given a config map, a table name, and an optional write-only worksheet, write the table to
+    its TSV file and the worksheet, and collect its messages. Return the checksum of the file."""
+    path = config["table"][table].path
     table_name = table
-    rows = config["db"].execute(f"SELECT * FROM `{table_name}`")
+    rows = config["db"].execute(f"SELECT * FROM {quote_identifier(table_name)}")
     fieldnames = []
     for column in rows.description:
         if column[0].endswith("_meta"):
             continue
         fieldnames.append(column[0])
     r = 1
-    with open(path, "w") as f:
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
         writer = csv.DictWriter(f, fieldnames, delimiter="\t", lineterminator="\n", extrasaction="ignore")
         writer.writeheader()
+        if sheet is not None:
+            sheet.append(fieldnames)
         for row in rows:
             r += 1
+            cells = []
             for column in fieldnames:
                 if f"{column}_meta" not in row:
+                    cells.append(row[column])
                     continue
                 meta = json.loads(row[f"{column}_meta"][5:-1])
                 if "value" in meta:
                     row[column] = meta["value"]
+                if sheet is not None:
+                    cells.append(xlsx_cell(sheet, row[column], meta.get("messages")))
                 if "messages" not in meta:
                     continue
                 cidx = fieldnames.index(column)
-                c = "ABCDEFGHIJK"[cidx]
+                c = get_column_letter(cidx + 1)
                 cell = f"{c}{r}"
                 for message in meta["messages"]:
                     message["table"] = table
                     message["cell"] = cell
                     config["message"].append(message)
             writer.writerow(row)
-
-def safe_sql(template, params):
-    """Given a SQL query template with variables and a dict of parameters,
-    return an escaped SQL string."""
-    stmt = sql_text(template).bindparams(**params)
-    return str(stmt.compile(compile_kwargs={"literal_binds": True}))
+            if sheet is not None:
+                sheet.append(cells)
+    return replace_if_changed(temp_path, path)
 
 def main():
     parser = ArgumentParser()
     parser.add_argument("db")
+    parser.add_argument(
+        "-x", "--xlsx", help="Also write the reference tables, highlighted, to this XLSX file"
+    )
     args = parser.parse_args()
     dir = os.path.split(args.db)[0]
     try:
         with sqlite3.connect(args.db) as conn:
             conn.row_factory = lambda c, r: dict(zip([col[0] for col in c.description], r))
             config = read_config_tables(conn)
+            config["db"] = conn
             config["message"] = []
             config["message_path"] = os.path.join(dir, "message.tsv")
+            config["xlsx_path"] = args.xlsx
             save_tables(config)
     except (FileNotFoundError, ValueError) as e:
         sys.exit(e)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+
+from argparse import ArgumentParser
+from gunicorn.app.base import BaseApplication
+
+from run import app, warm_connections
+
+
+class Application(BaseApplication):
+    """Serve the Flask app with gunicorn, configured from a dict of gunicorn settings instead of the
+    gunicorn command line."""
+
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def post_worker_init(worker):
+    """Open the tree databases in each worker after it forks, since SQLite connections must not be
+    shared across processes."""
+    warm_connections()
+
+
+def main():
+    """Run the browser app with multiple gunicorn worker processes, each with a pool of threads.
+    Send SIGHUP to the master process to gracefully replace the workers. Tree databases that are
+    rebuilt while serving are picked up by each worker on the next request for that tree."""
+    parser = ArgumentParser()
+    parser.add_argument("-b", "--bind", help="Address to listen on", default="127.0.0.1:5002")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of worker processes",
+        type=int,
+        default=multiprocessing.cpu_count() * 2 + 1,
+    )
+    parser.add_argument("-t", "--threads", help="Number of threads per worker", type=int, default=4)
+    parser.add_argument(
+        "--timeout", help="Seconds before a silent worker is restarted", type=int, default=60
+    )
+    args = parser.parse_args()
+
+    options = {
+        "bind": args.bind,
+        "workers": args.workers,
+        "worker_class": "gthread",
+        "threads": args.threads,
+        "timeout": args.timeout,
+        "graceful_timeout": args.timeout,
+        "post_worker_init": post_worker_init,
+    }
+    Application(app, options).run()
+
+
+if __name__ == "__main__":
+    main()
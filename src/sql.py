@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+
+import math
+
+
+def quote_identifier(name):
+    """Given a table or column name, return it quoted for use as an SQLite identifier."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def quote_literal(value):
+    """Given None, a number, or a string, return it as an SQLite literal. Non-finite floats have
+    no SQLite literal, so they are quoted as strings."""
+    if value is None:
+        return "NULL"
+    if isinstance(value, int) or (isinstance(value, float) and math.isfinite(value)):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
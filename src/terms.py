@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+
+from argparse import ArgumentParser
+from collections import OrderedDict, defaultdict
+
+from sql import quote_identifier
+
+# Reference columns holding term IDs, and the tree that each column's terms should be in
+TREE_COLUMNS = {
+    "host_organism_iri": "organism",
+    "host_organism_iris": "organism",
+    "source_organism_iri": "organism",
+    "source_organism_iris": "organism",
+    "parent_source_antigen_source_org_iri": "organism",
+    "parent_source_antigen_source_org_iris": "organism",
+    "r_object_source_organism_iri": "organism",
+    "r_object_source_organism_iris": "organism",
+    "parent_source_antigen_iri": "protein",
+    "parent_source_antigen_iris": "protein",
+    "non_peptidic_molecule_iri": "nonpeptide",
+    "non_peptidic_molecule_iris": "nonpeptide",
+    "r_object_source_molecule_iri": "molecule",
+    "r_object_source_molecule_iris": "molecule",
+    "assay_iris": "assay",
+    "disease_iris": "disease",
+}
+
+# Max number of term IDs in one query (IN (...)), below SQLite's default variable limit
+CHUNK_SIZE = 500
+
+# Max number of terms remembered across references
+CACHE_SIZE = 1 << 18
+
+# Prefix for the rules of the messages added by this stage, so they can be replaced on a rerun
+RULE = "tree"
+
+CURIE_PATTERN = re.compile(r"[A-Za-z_][\w.-]*:[\w.-]+")
+
+
+def get_tree_path(tree):
+    """Given a tree name, return the path to its database."""
+    if tree == "geolocation":
+        return "build/geolocation.db"
+    return f"build/{tree}-tree.db"
+
+
+class TermCache:
+    """An LRU cache of term details for each tree, shared by all the references checked in one run.
+    The details of a term are a pair of its label (or None) and whether it is obsolete, and terms
+    that are not in the tree are cached as None."""
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.terms = OrderedDict()
+        self.connections = {}
+
+    def connect(self, tree):
+        """Given a tree name, return a read-only connection to its database, or None if it has not
+        been built."""
+        if tree not in self.connections:
+            path = os.path.abspath(get_tree_path(tree))
+            if os.path.exists(path):
+                self.connections[tree] = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            else:
+                logging.warning(f"Skipping terms from the {tree} tree: {path} does not exist")
+                self.connections[tree] = None
+        return self.connections[tree]
+
+    def lookup(self, tree, curies):
+        """Given a tree name and a set of term IDs, return a dict from each ID to its details, or
+        None if the tree database does not exist. IDs that are not cached are queried in chunks."""
+        conn = self.connect(tree)
+        if not conn:
+            return None
+        results = {}
+        missing = []
+        for curie in curies:
+            key = (tree, curie)
+            if key in self.terms:
+                self.terms.move_to_end(key)
+                results[curie] = self.terms[key]
+            else:
+                missing.append(curie)
+
+        for i in range(0, len(missing), CHUNK_SIZE):
+            chunk = missing[i : i + CHUNK_SIZE]
+            found = {}
+            params = ", ".join("?" * len(chunk))
+            rows = conn.execute(
+                f"""SELECT stanza, predicate, value FROM statements
+                WHERE stanza IN ({params}) AND subject = stanza""",
+                chunk,
+            )
+            for stanza, predicate, value in rows:
+                label, obsolete = found.get(stanza, (None, False))
+                if predicate == "rdfs:label" and label is None:
+                    label = value
+                elif predicate == "owl:deprecated" and value == "true":
+                    obsolete = True
+                found[stanza] = (label, obsolete)
+            for curie in chunk:
+                results[curie] = found.get(curie)
+                self.terms[(tree, curie)] = results[curie]
+        while len(self.terms) > self.maxsize:
+            self.terms.popitem(last=False)
+        return results
+
+
+def read_meta(meta):
+    """Given a stored _meta string, return the cell dict."""
+    return json.loads(meta[5:-1])
+
+
+def write_meta(cell):
+    """Given a cell dict, return the string to store in its _meta column."""
+    return f"json({json.dumps(cell)})"
+
+
+def check_terms(conn, cache):
+    """Given a connection to a reference database and a TermCache, find every term ID in a column
+    listed in TREE_COLUMNS, look the IDs up in their trees in bulk, then record the labels of known
+    terms in each cell's metadata and add messages for unknown and obsolete terms. Unknown terms
+    make their cells invalid. Return the number of messages added."""
+    tables = [row[0] for row in conn.execute('SELECT "table" FROM "table"')]
+
+    # Collect the cells to check, and all the distinct term IDs for each tree:
+    cells = []
+    curies = defaultdict(set)
+    for table in tables:
+        for t in [table, table + "_conflict"]:
+            columns = [row[1] for row in conn.execute(f"PRAGMA table_info({quote_identifier(t)})")]
+            for column in columns:
+                if column not in TREE_COLUMNS or f"{column}_meta" not in columns:
+                    continue
+                tree = TREE_COLUMNS[column]
+                names = f"{quote_identifier(column)}, {quote_identifier(column + '_meta')}"
+                rows = conn.execute(f"SELECT rowid, {names} FROM {quote_identifier(t)}")
+                for rowid, stored, meta in rows:
+                    cell = read_meta(meta) if meta else {"valid": True, "messages": []}
+                    if cell.get("nulltype"):
+                        continue
+                    value = cell.get("value", stored)
+                    if not isinstance(value, str):
+                        continue
+                    found = CURIE_PATTERN.findall(value)
+                    if found:
+                        curies[tree].update(found)
+                        cells.append((t, column, tree, rowid, (stored, meta), value, cell, found))
+
+    terms = {}
+    for tree, ids in curies.items():
+        terms[tree] = cache.lookup(tree, sorted(ids))
+
+    count = 0
+    for t, column, tree, rowid, original, value, cell, found in cells:
+        if terms[tree] is None:
+            continue
+        # Replace the results of any earlier run:
+        messages = [m for m in cell["messages"] if not m["rule"].startswith(RULE)]
+        if len(messages) < len(cell["messages"]) and not cell["valid"]:
+            if not [m for m in messages if m["level"] == "error"]:
+                cell["valid"] = True
+        cell["messages"] = messages
+        labels = {}
+        for curie in found:
+            term = terms[tree][curie]
+            if term is None:
+                cell["valid"] = False
+                cell["messages"].append(
+                    {
+                        "rule": f"{RULE}:{tree}",
+                        "level": "error",
+                        "message": f"{curie} is not in the {tree} tree",
+                    }
+                )
+                count += 1
+                continue
+            label, obsolete = term
+            if label:
+                labels[curie] = label
+            if obsolete:
+                cell["messages"].append(
+                    {
+                        "rule": f"{RULE}:{tree}",
+                        "level": "warn",
+                        "message": f"{curie} is obsolete in the {tree} tree",
+                    }
+                )
+                count += 1
+        cell["labels"] = labels
+        # Invalid cells store their value in the metadata, and NULL in the column:
+        if cell["valid"]:
+            cell.pop("value", None)
+            stored = value
+        else:
+            cell["value"] = value
+            stored = None
+        meta = write_meta(cell)
+        # Leave cells that are already up to date alone, so their tables are not marked as changed:
+        if (stored, meta) == original:
+            continue
+        conn.execute(
+            "UPDATE {} SET {} = ?, {} = ? WHERE rowid = ?".format(
+                quote_identifier(t), quote_identifier(column), quote_identifier(column + "_meta")
+            ),
+            (stored, meta, rowid),
+        )
+    conn.commit()
+    return count
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("db", help="One or more reference databases to check", nargs="+")
+    parser.add_argument("-v", "--verbose", help="Run with increased logging", action="store_true")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+    else:
+        logging.getLogger().setLevel(logging.WARN)
+
+    cache = TermCache()
+    try:
+        for db in args.db:
+            with sqlite3.connect(db) as conn:
+                count = check_terms(conn, cache)
+            logging.info(f"Added {count} term messages to {db}")
+    except (FileNotFoundError, sqlite3.OperationalError) as e:
+        sys.exit(e)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,8 @@
 
 import re
 
+from sql import quote_identifier
+
 
 def validate_rows(config, table_name, rows):
     """Given a config map, a table name, and a list of rows (dicts from column names to column
@@ -15,9 +17,41 @@ def validate_rows(config, table_name, rows):
                 "valid": True,
             }
         result_rows.append(validate_row(config, table_name, result_row, result_rows))
+    validate_prefixes(config, table_name, result_rows)
     return result_rows
 
 
+def validate_prefixes(config, table_name, rows):
+    """Given a config map, a table name, and a list of validated rows, check that every value in a
+    CURIE column uses a known prefix. The distinct prefixes of the whole batch are checked against
+    the config's prefix index at once."""
+    index = config.get("prefixes")
+    if not index:
+        return
+    columns = config["table"][table_name].column
+    curie_columns = [
+        c.column for c in columns.values() if "CURIE" in config["datatype"][c.datatype].checks
+    ]
+    for column_name in curie_columns:
+        cells = [row[column_name] for row in rows if not row[column_name].get("nulltype")]
+        unknown = index.unknown_prefixes(cell["value"] for cell in cells)
+        if not unknown:
+            continue
+        for cell in cells:
+            prefix = cell["value"].partition(":")[0]
+            if prefix in unknown:
+                cell["valid"] = False
+                cell["messages"].append(
+                    {
+                        "rule": "prefix",
+                        "level": "error",
+                        "message": "Prefix {} of column {} is not in the prefix table".format(
+                            prefix, column_name
+                        ),
+                    }
+                )
+
+
 def validate_row(config, table_name, row, prev_results):
     """Given a config map, a table name, a row to validate (a dict from column names to column
     values), and a list of previously validated rows, return the validated row."""
@@ -35,15 +69,15 @@ def validate_row(config, table_name, row, prev_results):
 def validate_cell(config, table_name, column_name, cell, prev_results):
     """Given a config map, a table name, a column name, a cell to validate, and a list of previously
     validated rows (dicts mapping column names to column values), return the validated cell."""
-    column = config["table"][table_name]["column"][column_name]
+    column = config["table"][table_name].column[column_name]
     cell["messages"] = []
 
     # If the value of the cell is one of the allowable null-type values for this column, then
     # mark it as such and return immediately:
-    if column["nulltype"]:
-        nt_name = column["nulltype"]
+    if column.nulltype:
+        nt_name = column.nulltype
         nulltype = config["datatype"][nt_name]
-        result = validate_condition(nulltype["condition"], cell["value"])
+        result = validate_condition(nulltype.condition, cell["value"])
         if result:
             cell["nulltype"] = nt_name
             return cell
@@ -67,9 +101,10 @@ def validate_cell(config, table_name, column_name, cell, prev_results):
             cell["messages"].append(error_message)
         else:
             rows = config["db"].execute(
-                "SELECT 1 FROM `{}` WHERE `{}` = '{}' LIMIT 1".format(
-                    table_name, column["column"], cell["value"]
-                )
+                "SELECT 1 FROM {} WHERE {} = ? LIMIT 1".format(
+                    quote_identifier(table_name), quote_identifier(column.column)
+                ),
+                (cell["value"],),
             )
             if rows.fetchall():
                 cell["valid"] = False
@@ -79,9 +114,10 @@ def validate_cell(config, table_name, column_name, cell, prev_results):
     fkeys = [fkey for fkey in constraints["foreign"][table_name] if fkey["column"] == column_name]
     for fkey in fkeys:
         rows = config["db"].execute(
-            "SELECT 1 FROM `{}` WHERE `{}` = '{}' LIMIT 1".format(
-                fkey["ftable"], fkey["fcolumn"], cell["value"]
-            )
+            "SELECT 1 FROM {} WHERE {} = ? LIMIT 1".format(
+                quote_identifier(fkey["ftable"]), quote_identifier(fkey["fcolumn"])
+            ),
+            (cell["value"],),
         )
         if not rows.fetchall():
             cell["valid"] = False
@@ -95,29 +131,18 @@ def validate_cell(config, table_name, column_name, cell, prev_results):
                 }
             )
 
-    # Validate that the value of the cell conforms to the datatypes associated with the column:
-    def get_datatypes_to_check(dt_name):
-        datatypes = []
-        if dt_name is not None:
-            datatype = config["datatype"][dt_name]
-            if datatype["condition"] is not None:
-                datatypes.append(datatype)
-            datatypes += get_datatypes_to_check(datatype["parent"])
-        return datatypes
-
-    dt_name = column["datatype"]
-    datatypes_to_check = get_datatypes_to_check(dt_name)
-    # We use while and pop() instead of a for loop so as to check conditions in LIFO order:
-    while datatypes_to_check:
-        datatype = datatypes_to_check.pop()
-        if datatype["condition"].startswith("exclude") == validate_condition(
-            datatype["condition"], cell["value"]
+    # Validate that the value of the cell conforms to the datatypes associated with the column. The
+    # datatype's checks are already flattened, ordered from the root of the datatype tree down:
+    for dt_name in config["datatype"][column.datatype].checks:
+        datatype = config["datatype"][dt_name]
+        if datatype.condition.startswith("exclude") == validate_condition(
+            datatype.condition, cell["value"]
         ):
             cell["messages"].append(
                 {
-                    "rule": "datatype:{}".format(datatype["datatype"]),
+                    "rule": "datatype:{}".format(datatype.datatype),
                     "level": "error",
-                    "message": "{} should be {}".format(column_name, datatype["description"]),
+                    "message": "{} should be {}".format(column_name, datatype.description),
                 }
             )
             cell["valid"] = False